@@ -0,0 +1,50 @@
+"""vocadb.parse_response against the old decode, escape_bad_html over the whole body and json.loads, on made up
+stand-in responses: an album with its tracks, a song with lyrics and a search page.
+
+    $ python3 bench_parse.py --tracks 200 --number 500
+"""
+import argparse
+import json
+import timeit
+
+import standin
+from util import escape_bad_html
+from vocadb import parse_response
+
+
+def old_parse_response(body):
+    return json.loads(escape_bad_html(body.decode('utf-8')))
+
+
+def responses(tracks):
+    album = standin.album(1, {'fields': 'MainPicture,Names,Discs,Tracks'})
+    album['tracks'] = [{'discNumber': 1, 'trackNumber': n, 'name': 'Track {}'.format(n),
+                        'song': standin.song(100 + n, {'fields': 'Names,Artists'})} for n in range(tracks)]
+    return {
+        'album': album,
+        'lyrics': standin.song(1, {'fields': 'MainPicture,Names,Artists,PVs,Albums,Lyrics'}),
+        'search': standin.search(standin.entry, {'maxResults': 50}),
+    }
+
+
+def bench(options):
+    for name, data in responses(options.tracks).items():
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        times = [min(timeit.repeat(lambda: parse(body), number=options.number, repeat=options.repeat))
+                 / options.number for parse in (old_parse_response, parse_response)]
+        print('{:<8} {:>8} bytes  old {:>8.1f} µs  new {:>8.1f} µs  {:>4.1f}x'.format(
+            name, len(body), times[0] * 1e6, times[1] * 1e6, times[0] / times[1]))
+
+
+def parser():
+    p = argparse.ArgumentParser(description='Time parsing VocaDB responses.')
+    p.add_argument('--tracks', type=int, default=100, help='tracks on the album')
+    p.add_argument('--number', type=int, default=200, help='parses per timing')
+    p.add_argument('--repeat', type=int, default=5, help='timings of each, the best one is shown')
+    return p
+
+
+if __name__ == '__main__':
+    import sys
+
+    bench(parser().parse_args(sys.argv[1:]))
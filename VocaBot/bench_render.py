@@ -0,0 +1,290 @@
+"""Per entry cost of contentparser's templates against the text += parser they replaced, for search pages, info cards
+and album track lists. Both have to give the same text before they're timed.
+
+Entries come from the VocaDB stand-in, which runs in the background to answer the type name lookups.
+
+    $ python3 bench_render.py --number 2000
+"""
+import argparse
+import math
+import os
+import timeit
+from collections import defaultdict
+
+import standin
+
+# The type names are looked up from the stand-in, vocadb has to be imported once it's running
+server = standin.serve('--port', '0', background=True)
+os.environ['VOCABOT_API_ENDPOINT'] = server.endpoint
+
+from constants import Context  # noqa: E402
+from contentparser import content_parser, album_tracks  # noqa: E402
+from i18n import _  # noqa: E402
+from util import non_phone, escape_bad_html  # noqa: E402
+from vocadb import voca_db  # noqa: E402
+
+INFO_FIELDS = {'fields': 'MainPicture,Names,Artists,PVs,Albums'}
+ALBUM_FIELDS = {'fields': 'MainPicture,Names,Discs,Tracks'}
+
+
+# The parser as it was before the templates
+def old_names_text(song):
+    if len(song['names']) > 1:
+        names = _('<b>Additional names:</b>\n')
+        for name in song['names']:
+            if name['value'] != song['name']:
+                names += escape_bad_html(name['value']) + '\n'
+        return names
+
+    return _('No additional names found\n')
+
+
+def old_artists_text(entry, inline):
+    if len(entry['artists']) > 0:
+        artists = _('<b>Artists:</b>\n')
+        for artist in entry['artists']:
+            roles = []
+            for role in artist['effectiveRoles'].split(', '):
+                if role == 'Default':
+                    roles.append(artist['categories'][:2])
+                else:
+                    roles.append(role[:2])
+
+            artists += _('[<code>{roles}</code>] '
+                         '{artist_name}').format(roles=','.join(roles), artist_name=escape_bad_html(artist['name']))
+
+            if not inline:
+                try:
+                    artists += ' /ar_{}'.format(artist['artist']['id'])
+                except KeyError:
+                    pass
+
+            artists += '\n'
+
+        return artists
+
+    return _('No artists found\n')
+
+
+def old_content_parser(entries, info=False, inline=False, context=None, bot_name='', counts=None):
+    text = ''
+
+    if entries and len(entries) > 0:
+        if info:
+            entries = [entries]
+        for i, entry in enumerate(entries):
+            # Check if part of a disc listing
+            track_number = None
+            if 'trackNumber' in entry:
+                track_number = entry['trackNumber']
+                if 'song' in entry:
+                    entry = entry['song']
+
+            song, album, artist = False, False, False
+            if 'songType' in entry:
+                song = True
+            if 'artistType' in entry:
+                artist = True
+            if 'discType' in entry:
+                album = True
+
+            if track_number is None or i != 0:
+                text += '\n\n'
+
+            try:
+                if context == Context.related:
+                    if i == 0:
+                        text += _('<i>Matching artist</i>')
+                    elif i == 1:
+                        text += _('<i>Matching likes</i>')
+                    elif i == 2:
+                        text += _('<i>Matching tags</i>')
+                    text += '\n'
+
+                if song:
+                    if track_number is None:
+                        text += _('🎵 <b>{name}</b>\n'
+                                  '{artist}\n{type}').format(name=escape_bad_html(entry['name']),
+                                                             artist=escape_bad_html(entry['artistString']),
+                                                             type=voca_db.trans(entry['songType'], song=True))
+                        if 'favoritedTimes' in entry:
+                            text += ' ' + _('with {num} favourites').format(num=entry['favoritedTimes'])
+
+                    else:
+                        text += _('<code>{track_number})</code> <b>{name}</b>\n{artist}').format(
+                            track_number=track_number,
+                            name=escape_bad_html(entry['name']),
+                            artist=escape_bad_html(entry['artistString']))
+
+                if artist:
+                    text += _('🎤 <b>{name}</b>\n'
+                              '{type}').format(name=escape_bad_html(entry['name']),
+                                               type=voca_db.trans(entry['artistType'], artist=True))
+                if album:
+                    text += _('💿 <b>{name}</b>\n'
+                              '{artist}\n{type}').format(name=escape_bad_html(entry['name']),
+                                                         artist=escape_bad_html(entry['artistString']),
+                                                         type=voca_db.trans(entry['discType'], album=True))
+
+                if (not (song or artist or album)) and track_number:
+                    text += _('<code>{track_number})</code> <b>{name}</b>').format(
+                        track_number=track_number,
+                        name=escape_bad_html(entry['name']))
+                else:
+                    link = ''
+                    if song:
+                        link = 'info_{}'.format(entry['id'])
+                    elif artist:
+                        link = 'ar_{}'.format(entry['id'])
+                    elif album:
+                        link = 'al_{}'.format(entry['id'])
+
+                    if info:
+                        text += '\n\n'
+                        text += old_names_text(entry)
+                        text += '\n'
+                        if song:
+                            if not inline:
+                                text += _('<b>Derived songs:</b>') + ' /dev_{}\n'.format(entry['id'])
+                                text += _('<b>Related songs:</b>') + ' /rel_{}\n'.format(entry['id'])
+                                text += _('<b>Featured on albums:</b>') + ' /albys_{}\n'.format(entry['id'])
+                                if 'originalVersionId' in entry:
+                                    text += '\n'
+                                    text += _('<b>Original song:</b>') + ' /info_{}\n'.format(
+                                        entry['originalVersionId'])
+                                text += '\n'
+                                text += old_artists_text(entry, inline)
+
+                            if 'pvServices' in entry:
+                                if entry['pvServices'] == 'Nothing':
+                                    text += _('\nNo promotional videos found')
+
+                        if artist:
+                            if not inline:
+                                if 'baseVoicebank' in entry:
+                                    text += _('<b>Base voicebank:</b>') + ' /a_{}\n\n'.format(
+                                        entry['baseVoicebank']['id'])
+
+                        if album:
+                            if 'releaseDate' in entry:
+                                if not entry['releaseDate']['isEmpty']:
+                                    # i18n? .-.
+                                    text += _('Release date: {date}\n\n').format(
+                                        date=escape_bad_html(entry['releaseDate']['formatted']))
+
+                    else:
+                        if not inline:
+                            text += _('\nInfo:') + ' /' + link
+
+                    if inline and bot_name:
+                        text += _('<a href="https://telegram.me/{bot_name}?start=cmd%3D{link}">'
+                                  'Click for more features.</a>').format(bot_name=bot_name, link=link)
+
+            except OSError:
+                pass
+
+        if counts:
+            text += _("\n\nFound {found_num} total. "
+                      "Viewing page {cur_page}/{max_page}").format(found_num=non_phone(counts[1]),
+                                                                   cur_page=non_phone(math.ceil((counts[0] + 3) / 3)),
+                                                                   max_page=non_phone(math.ceil(counts[1] / 3)))
+
+    else:
+        if context == Context.search:
+            text += _("I couldn't find what you were looking for. Did you perhaps misspell it? "
+                      "(tip: you can edit your message.)")
+        elif context == Context.derived:
+            text += _('No derived songs found.')
+        elif context == Context.related:
+            text += _('No related songs found.')
+        elif context == Context.albums_by_song:
+            text += _('Not featured on any albums.')
+        else:
+            text += _('Not found.')
+
+    return text
+
+
+def old_album_tracks(album, inline):
+    text = _('<b>Tracks')
+    if not inline:
+        text += ' ' + _('on {album_name} by {album_artist}</b>\n').format(
+            album_name=escape_bad_html(album['name']),
+            album_artist=escape_bad_html(album['artistString']))
+    else:
+        text += ':</b>\n'
+
+    discs = defaultdict(list)
+    for track in album['tracks']:
+        discs[track['discNumber']].append(track)
+
+    for i, (disc_number, tracks) in enumerate(discs.items()):
+        if len(discs) > 1:
+            name = ''
+            if not i == 0:
+                text += '\n\n'
+            if 'discs' in album and album['discs']:
+                try:
+                    disc = [disc for disc in album['discs'] if disc['discNumber'] == disc_number][0]
+                    # Can't find an album to test this on:
+                    if 'name' in disc:
+                        name = disc['name']
+                    if 'mediaType' in disc:
+                        text += ('💿' if disc['mediaType'] == 'Audio' else '🎞') + ' '
+                except IndexError:
+                    pass
+            text += _('<i>Disc {disc_number}').format(disc_number=disc_number)
+            if name:
+                text += ' ({})'.format(escape_bad_html(name))
+            text += ':</i>\n'
+        text += old_content_parser(tracks, inline=inline)
+    return text
+
+
+def cases():
+    """name -> (render with the old parser, render with the new one, number of entries rendered)"""
+
+    page = standin.search(standin.entry, {'maxResults': 3})['items']
+    songs = standin.search(standin.song, {'maxResults': 3})['items']
+    cards = [standin.song(1, INFO_FIELDS), standin.artist(2, INFO_FIELDS), standin.album(3, ALBUM_FIELDS)]
+    album = standin.album(4, ALBUM_FIELDS)
+
+    def both(render, *args, **kwargs):
+        return (lambda: render(old_content_parser, *args, **kwargs),
+                lambda: render(content_parser, *args, **kwargs))
+
+    return {
+        'search page': both(lambda parse: parse(page, context=Context.search, counts=(0, 100))) + (len(page),),
+        'song page': both(lambda parse: parse(songs, context=Context.search, counts=(0, 100))) + (len(songs),),
+        'info card': both(lambda parse: [parse(card, info=True, bot_name='VocaDBBot') for card in cards])
+        + (len(cards),),
+        'inline card': both(lambda parse: [parse(card, info=True, inline=True, bot_name='VocaDBBot')
+                                           for card in cards]) + (len(cards),),
+        'track list': (lambda: old_album_tracks(album, inline=False), lambda: album_tracks(album, inline=False),
+                       len(album['tracks'])),
+    }
+
+
+def bench(options):
+    with _.using(options.interface):
+        for name, (old, new, entries) in cases().items():
+            # Also loads the translations and type names
+            assert old() == new(), name
+            times = [min(timeit.repeat(render, number=options.number, repeat=options.repeat)) / options.number
+                     for render in (old, new)]
+            print('{:<12} {:>3} entries  old {:>6.1f} µs  new {:>6.1f} µs per entry  {:>4.1f}x'.format(
+                name, entries, times[0] / entries * 1e6, times[1] / entries * 1e6, times[0] / times[1]))
+
+
+def parser():
+    p = argparse.ArgumentParser(description='Time contentparser per entry against the parser it replaced.')
+    p.add_argument('--interface', default='en_us', help='interface language to render in')
+    p.add_argument('--number', type=int, default=500, help='renders per timing')
+    p.add_argument('--repeat', type=int, default=5, help='timings of each, the best one is used')
+    return p
+
+
+if __name__ == '__main__':
+    import sys
+
+    bench(parser().parse_args(sys.argv[1:]))
@@ -0,0 +1,86 @@
+"""util.split against the splitter it replaced, which didn't know about tags, on long lyrics and on a tag-heavy
+track list.
+
+    $ python3 bench_split.py --size 1000000 --repeat 50
+"""
+import argparse
+import random
+import re
+import timeit
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+from util import split
+
+SEPS = ('\n\n', '\n', ' ')
+
+
+def old_split(text, max_length, seps, max_formatting=99):
+    """util.split before it kept tags whole, only the formatting limit looked at them."""
+    pieces, i = [], 0
+    while i < len(text):
+        piece = text[i:i + max_length]
+        if piece.count('<code>') + piece.count('<b>') + piece.count('<a>') > max_formatting:
+            # Find place of nth occurrence in string
+            for l, match in enumerate(re.finditer(r'(<code>|<b>|<a>)', piece)):
+                if l == max_formatting:
+                    piece = piece[0:match.end(1)]
+        if i + len(piece) >= len(text):
+            pieces.append(piece)
+            break
+        for j, sep in enumerate(seps):
+            before, __, after = piece.rpartition(sep)
+            if before == '':
+                # Last separator?
+                if j == len(seps) - 1:
+                    pieces.append(after)
+                    i += len(after) + len(sep)
+                    break
+            else:
+                pieces.append(before)
+                i += len(before) + len(sep)
+                break
+    return pieces
+
+
+def lyrics(size):
+    r = random.Random(0)
+    lines = ['<b>Lyrics</b>']
+    while size > 0:
+        lines.append(' '.join(r.choice(['ai', 'kokoro', 'sekai', 'yume', 'hoshi']) for __ in range(8)))
+        size -= len(lines[-1]) + 1
+    return '\n'.join(lines)
+
+
+def track_list(size):
+    """Like an album's track list, three tags and an entity per line."""
+    lines = []
+    while size > 0:
+        n = len(lines) + 1
+        lines.append('<b>{0}</b> <i>Track {0}</i> &amp; <a href="https://t.me/VocaDBBot?start=cmd%3Dinfo_{0}">'
+                     'info</a>'.format(n))
+        size -= len(lines[-1]) + 1
+    return '\n'.join(lines)
+
+
+def bench(options):
+    for name, make in (('lyrics', lyrics), ('tags', track_list)):
+        text = make(options.size)
+        pieces = list(split(text, MAX_MESSAGE_LENGTH - 1, SEPS))
+        times = [min(timeit.repeat(lambda: list(splitter(text, MAX_MESSAGE_LENGTH - 1, SEPS)),
+                                   number=1, repeat=options.repeat)) for splitter in (old_split, split)]
+        print('{:<8} {:>8} characters {:>4} pieces  old {:>7.2f} ms  new {:>7.2f} ms'.format(
+            name, len(text), len(pieces), times[0] * 1000, times[1] * 1000))
+
+
+def parser():
+    p = argparse.ArgumentParser(description='Time util.split against the old splitter.')
+    p.add_argument('--size', type=int, default=500000, help='characters of text to split')
+    p.add_argument('--repeat', type=int, default=20, help='times to split each text, the best one is used')
+    return p
+
+
+if __name__ == '__main__':
+    import sys
+
+    bench(parser().parse_args(sys.argv[1:]))
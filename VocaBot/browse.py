@@ -7,25 +7,71 @@ from telegram.ext import ConversationHandler
 from telegram.ext.dispatcher import run_async
 
 import info
-from constants import BrowseState
+from constants import BrowseState, Priority, PAGER_STORE_SIZE, PAGER_TTL
 from contentparser import content_parser
 from settings import with_voca_lang, translate, get_setting
-from vocadb import voca_db
-
-ongoing = {}
-replies = {}
+from state import backend
+from vocadb import voca_db, prioritized
+
+# Only specs of pagers that don't fit in the callback data (long search queries) are kept here
+ongoing = backend('pagers', PAGER_STORE_SIZE, PAGER_TTL, idle=True)
+replies = backend('replies', PAGER_STORE_SIZE, PAGER_TTL, idle=True)
+
+# code -> function(arg, lang) making the pager
+PAGERS = {
+    'e': lambda arg, lang: voca_db.entries(arg, lang),
+    's': lambda arg, lang: voca_db.songs(arg, lang),
+    'so': lambda arg, lang: voca_db.songs(arg, lang, originals_only=True),
+    'ar': lambda arg, lang: voca_db.artists(arg, lang),
+    'al': lambda arg, lang: voca_db.albums(arg, lang),
+    'n': lambda arg, lang: voca_db.songs(arg, lang, sort='AdditionDate'),
+    'ps': lambda arg, lang: voca_db.songs('', lang, artist_id=arg),
+    'ls': lambda arg, lang: voca_db.songs('', lang, artist_id=arg, sort='AdditionDate'),
+    'pa': lambda arg, lang: voca_db.albums('', lang, artist_id=arg, sort='RatingAverage'),
+    'la': lambda arg, lang: voca_db.albums('', lang, artist_id=arg, sort='ReleaseDate'),
+    'd': lambda arg, lang: voca_db.derived(arg, lang),
+    'r': lambda arg, lang: voca_db.related(arg, lang),
+    't': lambda arg, lang: voca_db.top_rated_songs(lang),
+    'as': lambda arg, lang: voca_db.albums_by_song(arg, lang),
+}
+# Short codes for the VocaDB languages in pager specs
+LANGS = {'d': 'Default', 'j': 'Japanese', 'r': 'Romaji', 'e': 'English'}
+LANG_CODES = {lang: code for code, lang in LANGS.items()}
+
+
+def pager(code, arg, lang):
+    """Makes a pager that remembers how it was made, so next_page can make it again from the callback data alone.
+    The language is part of that, so everyone paging through a message in a group gets the same results."""
+    page = PAGERS[code](arg, lang)
+    page.spec = '~{}.{}:{}'.format(code, LANG_CODES.get(lang, ''), arg)
+    return page
+
+
+def pager_key(page):
+    """The spec of the pager if the callback data fits in the 64 bytes telegram allows, else a key into ongoing."""
+    # 'page|' + spec + '|' + up to 4 digits of page number
+    if '\n' not in page.spec and len(page.spec.encode()) + 10 <= 64:
+        return page.spec
+    key = str(uuid.uuid4())
+    ongoing.set(key, page.spec)
+    return key
 
 
 @run_async
+@prioritized(Priority.interactive)
 @translate
-def next_page(bot, update, groups):
+@with_voca_lang
+def next_page(bot, update, groups, lang):
     key, cur_page = groups[1], groups[2]
     cur_page = int(cur_page)
-    try:
-        page_data, counts, context = ongoing[key](cur_page)
-    except KeyError:
+    spec = key if key.startswith('~') else ongoing.get(key)
+    if spec is None:
         bot.answer_callback_query(callback_query_id=update.callback_query.id, text='Expired! Please start over.')
         return ConversationHandler.END
+    code, arg = spec[1:].split(':', 1)
+    # Pagers from before the language was in the spec use the language of whoever pressed the button
+    code, __, lang_code = code.partition('.')
+    page_data, counts, context = pager(code, arg, LANGS.get(lang_code, lang))(cur_page)
 
     bot.edit_message_text(chat_id=update.callback_query.message.chat.id,
                           message_id=update.callback_query.message.message_id,
@@ -54,9 +100,10 @@ def send_page_one(bot, update, key, page, state):
             return None
 
     message_id = update.message.message_id
-    if message_id in replies:
+    reply = replies.get(str(message_id))
+    if reply:
         sent_message = bot.edit_message_text(chat_id=(update.message or update.callback_query.message).chat.id,
-                                             message_id=replies[message_id][1],
+                                             message_id=reply[1],
                                              text=content_parser(page_data, context=context, counts=counts),
                                              reply_markup=keyboard(key, counts),
                                              parse_mode=ParseMode.HTML)
@@ -67,7 +114,7 @@ def send_page_one(bot, update, key, page, state):
                                         reply_markup=keyboard(key, counts),
                                         parse_mode=ParseMode.HTML)
 
-    replies[message_id] = (state, sent_message.message_id)
+    replies.set(str(message_id), (state, sent_message.message_id))
 
     if update.callback_query:
         update.callback_query.answer()
@@ -101,8 +148,6 @@ def page_wrapper(f):
     @wraps(f)
     # @run_async  # This is a bad idea xD
     def wrapper(bot, update, *args, **kwargs):
-        key = str(uuid.uuid4())
-
         if update.edited_message:
             update.message = update.edited_message
 
@@ -111,9 +156,7 @@ def page_wrapper(f):
         if page is None:
             return state
 
-        state = send_page_one(bot, update, key, page, state)
-        ongoing[key] = page
-        return state
+        return send_page_one(bot, update, pager_key(page), page, state)
 
     return wrapper
 
@@ -124,14 +167,14 @@ def page_wrapper(f):
 def search(bot, update, args, lang, songs=False, artists=False, albums=False, state=None):
     query = args if type(args) == str else ' '.join(args)
     if songs and artists and albums:
-        entries = voca_db.entries(query, lang)
+        entries = pager('e', query, lang)
     elif songs:
-        originals_only = get_setting('originals', bot, update)
-        entries = voca_db.songs(query, lang, originals_only=originals_only)
+        originals_only = get_setting('originals', bot, update) == 'True'
+        entries = pager('so' if originals_only else 's', query, lang)
     elif artists:
-        entries = voca_db.artists(query, lang)
+        entries = pager('ar', query, lang)
     elif albums:
-        entries = voca_db.albums(query, lang)
+        entries = pager('al', query, lang)
     else:
         return None, None
     return entries, state
@@ -185,56 +228,51 @@ def search_album(bot, update, args):
 @translate
 @with_voca_lang
 def top(bot, update, lang):
-    return voca_db.songs('', lang), None
+    return pager('s', '', lang), None
 
 
 @page_wrapper
 @translate
 @with_voca_lang
 def new(bot, update, lang):
-    return voca_db.songs('', lang, sort='AdditionDate'), None
+    return pager('n', '', lang), None
 
 
+@prioritized(Priority.interactive)
 @page_wrapper
 @translate
 @with_voca_lang
 def artist(bot, update, groups, lang):
-    if groups[1] == 'ps':
-        return voca_db.songs('', lang, artist_id=groups[2]), None
-    elif groups[1] == 'ls':
-        return voca_db.songs('', lang, artist_id=groups[2], sort='AdditionDate'), None
-    elif groups[1] == 'pa':
-        return voca_db.albums('', lang, artist_id=groups[2], sort='RatingAverage'), None
-    elif groups[1] == 'la':
-        return voca_db.albums('', lang, artist_id=groups[2], sort='ReleaseDate'), None
+    if groups[1] in ('ps', 'ls', 'pa', 'la'):
+        return pager(groups[1], groups[2], lang), None
 
 
 @page_wrapper
 @translate
 @with_voca_lang
 def derived(bot, update, groups, lang):
-    return voca_db.derived(groups[1], lang), None
+    return pager('d', groups[1], lang), None
 
 
 @page_wrapper
 @translate
 @with_voca_lang
 def related(bot, update, groups, lang):
-    return voca_db.related(groups[1], lang), None
+    return pager('r', groups[1], lang), None
 
 
 @page_wrapper
 @translate
 @with_voca_lang
 def trending(bot, update, lang):
-    return voca_db.top_rated_songs(lang), None
+    return pager('t', '', lang), None
 
 
 @page_wrapper
 @translate
 @with_voca_lang
 def albums_by_song(bot, update, groups, lang):
-    return voca_db.albums_by_song(groups[1], lang), None
+    return pager('as', groups[1], lang), None
 
 
 def edited(bot, update, update_queue):
@@ -242,6 +280,7 @@ def edited(bot, update, update_queue):
         message_id = update.edited_message.message_id
         update.message = update.edited_message
         update.edited_message = None
-        if message_id in replies:
+        reply = replies.get(str(message_id))
+        if reply:
             update_queue.put(update)
-            return replies[message_id][0]
+            return reply[0]
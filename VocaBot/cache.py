@@ -0,0 +1,167 @@
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import ujson
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache where every entry has its own expiry time and the total size of all entries is bounded.
+
+    Sizes are whatever the caller says they are (fx. the length of the HTTP body a value was parsed from), the cache
+    just evicts least recently used entries until the sum fits inside max_size again.
+
+    With idle=True entries expire ttl seconds after they were last used instead of after they were set, and expired
+    entries are thrown away right away instead of being kept around for stale lookups.
+    """
+
+    def __init__(self, max_size, ttl=60 * 60, idle=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.idle = idle
+        self.size = 0
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+        self._lock = threading.Lock()
+        # key -> (expires, size, value)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None, stale=False):
+        """Expired entries are kept until they are evicted, pass stale=True to get them anyway."""
+        with self._lock:
+            try:
+                expires, size, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            now = time.monotonic()
+            if expires < now and not stale:
+                if self.idle:
+                    self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            if self.idle:
+                self._data[key] = (now + self.ttl, size, value)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, size=1):
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            now = time.monotonic()
+            self._data[key] = (now + (self.ttl if ttl is None else ttl), size, value)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+            if self.idle:
+                # Least recently used first, so the expired ones are all at the front
+                while self._data:
+                    oldest = next(iter(self._data))
+                    if self._data[oldest][0] >= now:
+                        break
+                    self._remove(oldest)
+                    self.expirations += 1
+
+    def items(self):
+        """List of (key, value) of the entries that haven't expired."""
+        with self._lock:
+            now = time.monotonic()
+            return [(key, value) for key, (expires, __, value) in self._data.items() if expires >= now]
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= self._data.pop(key)[1]
+
+    def stats(self):
+        return {'entries': len(self._data), 'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+def deep_sizeof(obj, seen=None):
+    """Rough size in bytes of obj and the plain containers and values inside it. Anything else isn't counted."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif not isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return 0
+    return size
+
+
+class DiskCache(object):
+    """SQLite backed cache for JSON-able values, so they survive restarts. Keys have to be strings."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, default=None):
+        """Returns (value, seconds left, size) or default."""
+        with self._lock:
+            row = self._db.execute('SELECT value, expires FROM cache WHERE key = ? AND expires > ?',
+                                   (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return ujson.loads(row[0]), row[1] - time.time(), len(row[0])
+
+    def set(self, key, value, ttl):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                             (key, time.time() + ttl, ujson.dumps(value)))
+
+    def items(self, max_size):
+        """Yields (key, value, seconds left, size) for the entries expiring last, up to max_size bytes in total.
+        Oldest first, so they can be fed straight into a TTLCache."""
+        with self._lock:
+            rows = self._db.execute('SELECT key, value, expires FROM cache WHERE expires > ? ORDER BY expires DESC',
+                                    (time.time(),))
+            selected, total = [], 0
+            for key, value, expires in rows:
+                total += len(value)
+                if total > max_size:
+                    break
+                selected.append((key, value, expires))
+        for key, value, expires in reversed(selected):
+            yield key, ujson.loads(value), expires - time.time(), len(value)
+
+    def purge(self):
+        with self._lock, self._db:
+            return self._db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),)).rowcount
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        return {'entries': entries, 'hits': self.hits, 'misses': self.misses}
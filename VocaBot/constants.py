@@ -1,11 +1,45 @@
+import os
 from enum import Enum
 from pathlib import Path
 
 __version__ = "2.0.0"
-VOCADB_API_ENDPOINT = "https://vocadb.net/api/"
+# Can be pointed at a local stand-in, see standin.py
+VOCADB_API_ENDPOINT = os.getenv('VOCABOT_API_ENDPOINT', "https://vocadb.net/api/")
 VOCADB_BASE_URL = 'https://vocadb.net/'
 OWNER_IDS = (95205500,)
 DB_FILE = Path('../data.json')
+# Settings are kept in SETTINGS_DB_FILE, set VOCABOT_SETTINGS_BACKEND=tinydb to keep using DB_FILE instead
+SETTINGS_BACKEND = os.getenv('VOCABOT_SETTINGS_BACKEND', 'sqlite')
+SETTINGS_DB_FILE = DB_FILE.parent / 'settings.sqlite'
+# How many users' settings are kept in memory and for how long, and how often changes are saved (in seconds)
+SETTINGS_CACHE_SIZE = int(os.getenv('VOCABOT_SETTINGS_CACHE_SIZE', 100000))
+SETTINGS_CACHE_TTL = int(os.getenv('VOCABOT_SETTINGS_CACHE_TTL', 5 * 60))
+SETTINGS_FLUSH_INTERVAL = float(os.getenv('VOCABOT_SETTINGS_FLUSH_INTERVAL', 1))
+# Set VOCABOT_DISK_CACHE=1 to keep VocaDB entity lookups in a sqlite file next to DB_FILE across restarts
+DISK_CACHE_FILE = DB_FILE.parent / 'cache.sqlite' if os.getenv('VOCABOT_DISK_CACHE', '0') != '0' else None
+# Max total size in bytes of the VocaDB responses kept in memory
+VOCADB_CACHE_SIZE = int(os.getenv('VOCABOT_CACHE_SIZE', 32 * 1024 * 1024))
+# Max total size in bytes of the rendered song, artist and album cards kept in memory
+CARD_CACHE_SIZE = int(os.getenv('VOCABOT_CARD_CACHE_SIZE', 8 * 1024 * 1024))
+# How many search results to fetch at a time. Pages are served from these blocks.
+VOCADB_BLOCK_SIZE = int(os.getenv('VOCABOT_BLOCK_SIZE', 30))
+# How many times a failed (timed out, connection error or 5xx) VocaDB request is retried
+VOCADB_RETRIES = int(os.getenv('VOCABOT_RETRIES', 2))
+# Requests per second (0 to disable) and burst size for outgoing VocaDB requests
+VOCADB_RATE_LIMIT = float(os.getenv('VOCABOT_RATE_LIMIT', 10))
+VOCADB_RATE_BURST = int(os.getenv('VOCABOT_RATE_BURST', 20))
+# Max total size in bytes of the search results kept around for browse and inline paging, and how many seconds
+# a search can sit unused before it's forgotten
+PAGER_STORE_SIZE = int(os.getenv('VOCABOT_PAGER_STORE_SIZE', 64 * 1024 * 1024))
+PAGER_TTL = int(os.getenv('VOCABOT_PAGER_TTL', 60 * 60))
+# memory, or memcached://host:port[,host:port...] to share pagers, conversations and VocaDB responses between bot
+# processes, see state.py
+STATE_BACKEND = os.getenv('VOCABOT_STATE_BACKEND', 'memory')
+# Seconds between preloading translations and the first /top, /new and /trending pages (0 to disable)
+WARMUP_INTERVAL = int(os.getenv('VOCABOT_WARMUP_INTERVAL', 10 * 60))
+WARMUP_HOT_LISTS = os.getenv('VOCABOT_WARMUP_HOT_LISTS', '1') != '0'
+# Seconds between rebuilding the index short inline queries are answered from (0 to disable), see prefixindex.py
+PREFIX_INDEX_INTERVAL = int(os.getenv('VOCABOT_PREFIX_INDEX_INTERVAL', 5 * 60))
 VOCADB_USER_AGENT = 'Telegram-{bot_name}/{version}'.format(bot_name='{bot_name}', version=__version__)
 LOCALE_FOLDER = 'Locales'
 LOCALE_NAME = 'VocaBot'
@@ -18,4 +52,6 @@ SettingState = Enum('SettingState', 'settings interface voca')
 # noinspection PyArgumentList
 BrowseState = Enum('BrowseState', 'input input_song input_artist input_album page')
 # noinspection PyArgumentList
+Priority = Enum('Priority', 'interactive normal background')
+# noinspection PyArgumentList
 Context = Enum('ContentErrors', 'search derived related albums_by_song')
\ No newline at end of file
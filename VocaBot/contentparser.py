@@ -3,49 +3,115 @@ from collections import defaultdict
 
 from constants import Context, VOCADB_BASE_URL
 from i18n import _
-from util import non_phone
+from util import non_phone, escape_bad_html
 from vocadb import voca_db
 
 
 # I'm not exactly proud of this module's code.. but it does the job.
 
 
-def names_text(song):
-    if len(song['names']) > 1:
-        names = _('<b>Additional names:</b>\n')
-        for name in song['names']:
-            if name['value'] != song['name']:
-                names += name['value'] + '\n'
+def command_line(label, command):
+    """The translated label followed by the command for an id. Only the command is formatted, so braces in a
+    translation don't matter."""
+    return lambda iden: label + command.format(iden)
+
+
+class Templates(object):
+    """Every string content_parser needs, translated to one interface language. Translating is slow, so it's only done
+    once per language."""
+
+    def __init__(self):
+        self.names = _('<b>Additional names:</b>\n')
+        self.no_names = _('No additional names found\n')
+        self.artists = _('<b>Artists:</b>\n')
+        self.artist = _('[<code>{roles}</code>] {artist_name}').format
+        self.no_artists = _('No artists found\n')
+        self.related = {0: _('<i>Matching artist</i>'), 1: _('<i>Matching likes</i>'), 2: _('<i>Matching tags</i>')}
+        self.song = _('🎵 <b>{name}</b>\n'
+                      '{artist}\n{type}').format
+        self.favourites = ' ' + _('with {num} favourites')
+        self.song_track = _('<code>{track_number})</code> <b>{name}</b>\n{artist}').format
+        self.artist_card = _('🎤 <b>{name}</b>\n'
+                             '{type}').format
+        self.album = _('💿 <b>{name}</b>\n'
+                       '{artist}\n{type}').format
+        self.track = _('<code>{track_number})</code> <b>{name}</b>').format
+        self.derived = command_line(_('<b>Derived songs:</b>'), ' /dev_{}\n')
+        self.related_songs = command_line(_('<b>Related songs:</b>'), ' /rel_{}\n')
+        self.albums_by_song = command_line(_('<b>Featured on albums:</b>'), ' /albys_{}\n')
+        self.original = command_line(_('<b>Original song:</b>'), ' /info_{}\n')
+        self.no_pvs = _('\nNo promotional videos found')
+        self.base_voicebank = command_line(_('<b>Base voicebank:</b>'), ' /a_{}\n\n')
+        # i18n? .-.
+        self.release_date = _('Release date: {date}\n\n').format
+        self.info = _('\nInfo:') + ' /'
+        self.more = _('<a href="https://telegram.me/{bot_name}?start=cmd%3D{link}">'
+                      'Click for more features.</a>').format
+        self.counts = _("\n\nFound {found_num} total. "
+                        "Viewing page {cur_page}/{max_page}").format
+        self.not_found = {Context.search: _("I couldn't find what you were looking for. Did you perhaps misspell it? "
+                                            "(tip: you can edit your message.)"),
+                          Context.derived: _('No derived songs found.'),
+                          Context.related: _('No related songs found.'),
+                          Context.albums_by_song: _('Not featured on any albums.'),
+                          None: _('Not found.')}
+        self.tracks = _('<b>Tracks')
+        self.tracks_of = ' ' + _('on {album_name} by {album_artist}</b>\n')
+        self.disc = _('<i>Disc {disc_number}').format
+
+
+class TypeNames(dict):
+    """kind -> translated song, artist or album type names. Only looked up when an entry of that kind shows up."""
+
+    def __init__(self, code):
+        super().__init__()
+        self.code = code
+
+    def __missing__(self, kind):
+        names = self[kind] = voca_db.type_names(self.code).get(kind, {})
         return names
 
-    return _('No additional names found\n')
 
+# interface language code -> Templates
+compiled = {}
+
+
+def templates():
+    t = compiled.get(_.code)
+    if t is None:
+        t = compiled[_.code] = Templates()
+    return t
+
+
+def names_text(song, t=None):
+    t = t or templates()
+    if len(song['names']) > 1:
+        return t.names + ''.join(escape_bad_html(name['value']) + '\n' for name in song['names']
+                                 if name['value'] != song['name'])
 
-def artists_text(entry, inline):
+    return t.no_names
+
+
+def artists_text(entry, inline, t=None):
+    t = t or templates()
     if len(entry['artists']) > 0:
-        artists = _('<b>Artists:</b>\n')
+        parts = [t.artists]
         for artist in entry['artists']:
-            roles = []
-            for role in artist['effectiveRoles'].split(', '):
-                if role == 'Default':
-                    roles.append(artist['categories'][:2])
-                else:
-                    roles.append(role[:2])
-
-            artists += _('[<code>{roles}</code>] '
-                         '{artist_name}').format(roles=','.join(roles), artist_name=artist['name'])
+            roles = [artist['categories'][:2] if role == 'Default' else role[:2]
+                     for role in artist['effectiveRoles'].split(', ')]
+            parts.append(t.artist(roles=','.join(roles), artist_name=escape_bad_html(artist['name'])))
 
             if not inline:
                 try:
-                    artists += ' /ar_{}'.format(artist['artist']['id'])
+                    parts.append(' /ar_{}'.format(artist['artist']['id']))
                 except KeyError:
                     pass
 
-            artists += '\n'
+            parts.append('\n')
 
-        return artists
+        return ''.join(parts)
 
-    return _('No artists found\n')
+    return t.no_artists
 
 
 def vocadb_url(entry, song=False, artist=False, album=False):
@@ -54,151 +120,114 @@ def vocadb_url(entry, song=False, artist=False, album=False):
                                           id=entry['id'])
 
 
+def render_entry(parts, t, types, i, entry, info, inline, context, bot_name):
+    # Check if part of a disc listing
+    track_number = None
+    if 'trackNumber' in entry:
+        track_number = entry['trackNumber']
+        if 'song' in entry:
+            entry = entry['song']
+
+    song = 'songType' in entry
+    artist = 'artistType' in entry
+    album = 'discType' in entry
+
+    if track_number is None or i != 0:
+        parts.append('\n\n')
+
+    if context == Context.related:
+        if i in t.related:
+            parts.append(t.related[i])
+        parts.append('\n')
+
+    if song:
+        if track_number is None:
+            parts.append(t.song(name=escape_bad_html(entry['name']), artist=escape_bad_html(entry['artistString']),
+                                type=types['song'].get(entry['songType'], entry['songType'])))
+            if 'favoritedTimes' in entry:
+                parts.append(t.favourites.format(num=entry['favoritedTimes']))
+        else:
+            parts.append(t.song_track(track_number=track_number, name=escape_bad_html(entry['name']),
+                                      artist=escape_bad_html(entry['artistString'])))
+
+    if artist:
+        parts.append(t.artist_card(name=escape_bad_html(entry['name']),
+                                   type=types['artist'].get(entry['artistType'], entry['artistType'])))
+    if album:
+        parts.append(t.album(name=escape_bad_html(entry['name']), artist=escape_bad_html(entry['artistString']),
+                             type=types['album'].get(entry['discType'], entry['discType'])))
+
+    if (not (song or artist or album)) and track_number:
+        parts.append(t.track(track_number=track_number, name=escape_bad_html(entry['name'])))
+        return
+
+    link = ''
+    if song:
+        link = 'info_{}'.format(entry['id'])
+    elif artist:
+        link = 'ar_{}'.format(entry['id'])
+    elif album:
+        link = 'al_{}'.format(entry['id'])
+
+    if info:
+        parts.append('\n\n')
+        parts.append(names_text(entry, t))
+        parts.append('\n')
+        if song:
+            if not inline:
+                parts.append(t.derived(entry['id']))
+                parts.append(t.related_songs(entry['id']))
+                parts.append(t.albums_by_song(entry['id']))
+                if 'originalVersionId' in entry:
+                    parts.append('\n')
+                    parts.append(t.original(entry['originalVersionId']))
+                parts.append('\n')
+                parts.append(artists_text(entry, inline, t))
+
+            if entry.get('pvServices') == 'Nothing':
+                parts.append(t.no_pvs)
+
+        if artist and not inline and 'baseVoicebank' in entry:
+            parts.append(t.base_voicebank(entry['baseVoicebank']['id']))
+
+        if album and 'releaseDate' in entry and not entry['releaseDate']['isEmpty']:
+            parts.append(t.release_date(date=escape_bad_html(entry['releaseDate']['formatted'])))
+
+    elif not inline:
+        parts.append(t.info + link)
+
+    if inline and bot_name:
+        parts.append(t.more(bot_name=bot_name, link=link))
+
+
 def content_parser(entries, info=False, inline=False, context=None, bot_name='', counts=None):
-    text = ''
+    t = templates()
 
     if entries and len(entries) > 0:
         if info:
             entries = [entries]
+        types = TypeNames(_.code)
+        parts = []
         for i, entry in enumerate(entries):
-            # Check if part of a disc listing
-            track_number = None
-            if 'trackNumber' in entry:
-                track_number = entry['trackNumber']
-                if 'song' in entry:
-                    entry = entry['song']
-
-            song, album, artist = False, False, False
-            if 'songType' in entry:
-                song = True
-            if 'artistType' in entry:
-                artist = True
-            if 'discType' in entry:
-                album = True
-
-            if track_number is None or i != 0:
-                text += '\n\n'
-
-            try:
-                if context == Context.related:
-                    if i == 0:
-                        text += _('<i>Matching artist</i>')
-                    elif i == 1:
-                        text += _('<i>Matching likes</i>')
-                    elif i == 2:
-                        text += _('<i>Matching tags</i>')
-                    text += '\n'
-
-                if song:
-                    if track_number is None:
-                        text += _('🎵 <b>{name}</b>\n'
-                                  '{artist}\n{type}').format(name=entry['name'],
-                                                             artist=entry['artistString'],
-                                                             type=voca_db.trans(entry['songType'], song=True))
-                        if 'favoritedTimes' in entry:
-                            text += ' ' + _('with {num} favourites').format(num=entry['favoritedTimes'])
-
-                    else:
-                        text += _('<code>{track_number})</code> <b>{name}</b>\n{artist}').format(
-                            track_number=track_number,
-                            name=entry['name'],
-                            artist=entry['artistString'])
-
-                if artist:
-                    text += _('🎤 <b>{name}</b>\n'
-                              '{type}').format(name=entry['name'],
-                                               type=voca_db.trans(entry['artistType'], artist=True))
-                if album:
-                    text += _('💿 <b>{name}</b>\n'
-                              '{artist}\n{type}').format(name=entry['name'],
-                                                         artist=entry['artistString'],
-                                                         type=voca_db.trans(entry['discType'], album=True))
-
-                if (not (song or artist or album)) and track_number:
-                    text += _('<code>{track_number})</code> <b>{name}</b>').format(
-                        track_number=track_number,
-                        name=entry['name'])
-                else:
-                    link = ''
-                    if song:
-                        link = 'info_{}'.format(entry['id'])
-                    elif artist:
-                        link = 'ar_{}'.format(entry['id'])
-                    elif album:
-                        link = 'al_{}'.format(entry['id'])
-
-                    if info:
-                        text += '\n\n'
-                        text += names_text(entry)
-                        text += '\n'
-                        if song:
-                            if not inline:
-                                text += _('<b>Derived songs:</b>') + ' /dev_{}\n'.format(entry['id'])
-                                text += _('<b>Related songs:</b>') + ' /rel_{}\n'.format(entry['id'])
-                                text += _('<b>Featured on albums:</b>') + ' /albys_{}\n'.format(entry['id'])
-                                if 'originalVersionId' in entry:
-                                    text += '\n'
-                                    text += _('<b>Original song:</b>') + ' /info_{}\n'.format(
-                                        entry['originalVersionId'])
-                                text += '\n'
-                                text += artists_text(entry, inline)
-
-                            if 'pvServices' in entry:
-                                if entry['pvServices'] == 'Nothing':
-                                    text += _('\nNo promotional videos found')
-
-                        if artist:
-                            if not inline:
-                                if 'baseVoicebank' in entry:
-                                    text += _('<b>Base voicebank:</b>') + ' /a_{}\n\n'.format(
-                                        entry['baseVoicebank']['id'])
-
-                        if album:
-                            if 'releaseDate' in entry:
-                                if not entry['releaseDate']['isEmpty']:
-                                    # i18n? .-.
-                                    text += _('Release date: {date}\n\n').format(date=entry['releaseDate']['formatted'])
-
-                    else:
-                        if not inline:
-                            text += _('\nInfo:') + ' /' + link
-
-                    if inline and bot_name:
-                        text += _('<a href="https://telegram.me/{bot_name}?start=cmd%3D{link}">'
-                                  'Click for more features.</a>').format(bot_name=bot_name, link=link)
-
-            except OSError:
-                pass
+            render_entry(parts, t, types, i, entry, info, inline, context, bot_name)
 
         if counts:
-            text += _("\n\nFound {found_num} total. "
-                      "Viewing page {cur_page}/{max_page}").format(found_num=non_phone(counts[1]),
-                                                                   cur_page=non_phone(math.ceil((counts[0] + 3) / 3)),
-                                                                   max_page=non_phone(math.ceil(counts[1] / 3)))
-
-    else:
-        if context == Context.search:
-            text += _("I couldn't find what you were looking for. Did you perhaps misspell it? "
-                      "(tip: you can edit your message.)")
-        elif context == Context.derived:
-            text += _('No derived songs found.')
-        elif context == Context.related:
-            text += _('No related songs found.')
-        elif context == Context.albums_by_song:
-            text += _('Not featured on any albums.')
-        else:
-            text += _('Not found.')
+            parts.append(t.counts(found_num=non_phone(counts[1]),
+                                  cur_page=non_phone(math.ceil((counts[0] + 3) / 3)),
+                                  max_page=non_phone(math.ceil(counts[1] / 3))))
+        return ''.join(parts)
 
-    return text
+    return t.not_found.get(context, t.not_found[None])
 
 
 def album_tracks(album, inline):
-    text = _('<b>Tracks')
+    t = templates()
+    parts = [t.tracks]
     if not inline:
-        text += ' ' + _('on {album_name} by {album_artist}</b>\n').format(album_name=album['name'],
-                                                                          album_artist=album['artistString'])
+        parts.append(t.tracks_of.format(album_name=escape_bad_html(album['name']),
+                                        album_artist=escape_bad_html(album['artistString'])))
     else:
-        text += ':</b>\n'
+        parts.append(':</b>\n')
 
     discs = defaultdict(list)
     for track in album['tracks']:
@@ -208,7 +237,7 @@ def album_tracks(album, inline):
         if len(discs) > 1:
             name = ''
             if not i == 0:
-                text += '\n\n'
+                parts.append('\n\n')
             if 'discs' in album and album['discs']:
                 try:
                     disc = [disc for disc in album['discs'] if disc['discNumber'] == disc_number][0]
@@ -216,12 +245,12 @@ def album_tracks(album, inline):
                     if 'name' in disc:
                         name = disc['name']
                     if 'mediaType' in disc:
-                        text += ('💿' if disc['mediaType'] == 'Audio' else '🎞') + ' '
+                        parts.append(('💿' if disc['mediaType'] == 'Audio' else '🎞') + ' ')
                 except IndexError:
                     pass
-            text += _('<i>Disc {disc_number}').format(disc_number=disc_number)
+            parts.append(t.disc(disc_number=disc_number))
             if name:
-                text += ' ({})'.format(name)
-            text += ':</i>\n'
-        text += content_parser(tracks, inline=inline)
-    return text
+                parts.append(' ({})'.format(escape_bad_html(name)))
+            parts.append(':</i>\n')
+        parts.append(content_parser(tracks, inline=inline))
+    return ''.join(parts)
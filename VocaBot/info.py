@@ -1,13 +1,19 @@
 from urllib.parse import unquote
 
-from constants import PV_SERVICES
+from cache import TTLCache
+from constants import PV_SERVICES, Priority, CARD_CACHE_SIZE
 from contentparser import content_parser, album_tracks, vocadb_url
 from i18n import _
 from settings import with_voca_lang, translate
 from telegram import ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext.dispatcher import run_async
-from util import edit_message_text, pv_parser, get_lyric_lang
-from vocadb import voca_db
+from util import edit_message_text, pv_parser, get_lyric_lang, escape_bad_html
+from vocadb import voca_db, prioritized, cache_ttl
+
+# Rendered cards, and the responses they were made from
+cards = TTLCache(CARD_CACHE_SIZE, ttl=cache_ttl('songs/0', {}))
+# Roughly what a keyboard takes up
+KEYBOARD_SIZE = 2048
 
 
 # noinspection PyTypeChecker
@@ -21,13 +27,16 @@ def song_keyboard(data, inline=False):
     # TODO: Add "Artist Info" button to inline
 
     # If it's from an entry search we get pVs instead of pvServices
+    # Not stored back into data since that might be shared with the response cache
     if 'pVs' in data:
-        data['pvServices'] = ', '.join([x['service'] for x in data['pVs']])
+        pv_services = ', '.join([x['service'] for x in data['pVs']])
+    else:
+        pv_services = data['pvServices']
 
-    if not data['pvServices'] == 'Nothing':
+    if not pv_services == 'Nothing':
         keyboard.append([])
         for service in PV_SERVICES:
-            if service in data['pvServices']:
+            if service in pv_services:
                 callback_data = 'pv|{}|{}'.format(data['id'], service)
                 keyboard[-1].append(InlineKeyboardButton(text='🎥' + service,
                                                          callback_data=callback_data))
@@ -83,13 +92,33 @@ def album_keyboard(data, inline=False):
     return InlineKeyboardMarkup(keyboard)
 
 
+KEYBOARDS = (('songType', song_keyboard), ('artistType', artist_keyboard), ('discType', album_keyboard))
+
+
+def card(data, lang, inline=False, bot_name=''):
+    """content_parser(data, info=True, ...) and the keyboard that goes with it. The same popular cards get shown over
+    and over, so they are only rendered once for every language and way they're shown in."""
+    kind, keyboard = next(((kind, keyboard) for kind, keyboard in KEYBOARDS if data and kind in data), (None, None))
+    if kind is None or 'id' not in data:
+        return content_parser(data, info=True, inline=inline, bot_name=bot_name), None
+    # Search results and entity lookups of the same thing don't have the same fields
+    key = (kind, data['id'], lang, _.code, inline, bot_name if inline else '', frozenset(data))
+    cached = cards.get(key)
+    # VocaDB responses are cached and handed out as is, a different one means it has been fetched again since
+    if cached is not None and cached[0] is data:
+        return cached[1]
+    rendered = (content_parser(data, info=True, inline=inline, bot_name=bot_name), keyboard(data, inline=inline))
+    cards.set(key, (data, rendered), size=len(rendered[0]) + KEYBOARD_SIZE)
+    return rendered
+
+
 @run_async
 @translate
 @with_voca_lang
 def song(bot, update, groups, lang):
     data = voca_db.song(groups[0], 'MainPicture, Names, Lyrics, Artists, PVs', lang=lang)
-    update.message.reply_text(content_parser(data, info=True), reply_markup=song_keyboard(data),
-                              parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    text, keyboard = card(data, lang)
+    update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
 
 @run_async
@@ -97,8 +126,8 @@ def song(bot, update, groups, lang):
 @with_voca_lang
 def artist(bot, update, groups, lang):
     data = voca_db.artist(groups[0], 'MainPicture, Names', lang=lang)
-    update.message.reply_text(content_parser(data, info=True), reply_markup=artist_keyboard(data),
-                              parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    text, keyboard = card(data, lang)
+    update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
 
 @run_async
@@ -106,11 +135,12 @@ def artist(bot, update, groups, lang):
 @with_voca_lang
 def album(bot, update, groups, lang):
     data = voca_db.album(groups[0], 'MainPicture, Names, Discs, Tracks', lang=lang)
-    update.message.reply_text(content_parser(data, info=True), reply_markup=album_keyboard(data),
-                              parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    text, keyboard = card(data, lang)
+    update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
 
 @run_async
+@prioritized(Priority.interactive)
 @translate
 @with_voca_lang
 def lyrics(bot, update, groups, lang):
@@ -126,8 +156,8 @@ def lyrics(bot, update, groups, lang):
     if data['lyrics']:
         if groups[1] == '':
             text = _('What language would you like the lyrics for <b>{name} by {artist}</b> in?').format(
-                name=data['name'],
-                artist=data['artistString'])
+                name=escape_bad_html(data['name']),
+                artist=escape_bad_html(data['artistString']))
             edit_message_text(bot, update, send_if_possible=True,
                               text=text,
                               reply_markup=reply_keyboard,
@@ -136,19 +166,19 @@ def lyrics(bot, update, groups, lang):
         else:
             for lyric in data['lyrics']:
                 if lyric['id'] == int(groups[1]):
-                    text = ''
+                    text, keyboard = '', reply_keyboard
                     if inline:
-                        text = content_parser(data, info=True, inline=True, bot_name=bot.username)
+                        text, keyboard = card(data, lang, inline=True, bot_name=bot.username)
                     text += '\n\n' + '📜'
                     text += _('<b>{lang} lyrics for {song} by {artist}</b>\n'
-                              '{lyrics}').format(song=data['name'],
-                                                 artist=data['artistString'],
+                              '{lyrics}').format(song=escape_bad_html(data['name']),
+                                                 artist=escape_bad_html(data['artistString']),
                                                  lang=get_lyric_lang(lyric['translationType'], lyric['cultureCode'],
                                                                      long=True),
-                                                 lyrics=lyric['value'])
+                                                 lyrics=escape_bad_html(lyric['value']))
                     edit_message_text(bot, update,
                                       text=text,
-                                      reply_markup=song_keyboard(data, inline=True) if inline else reply_keyboard,
+                                      reply_markup=keyboard,
                                       parse_mode=ParseMode.HTML)
                     update.callback_query.answer()
     else:
@@ -156,6 +186,7 @@ def lyrics(bot, update, groups, lang):
 
 
 @run_async
+@prioritized(Priority.interactive)
 @translate
 @with_voca_lang
 def pv(bot, update, groups, lang):
@@ -166,19 +197,17 @@ def pv(bot, update, groups, lang):
     # TODO: Deal with several of the same service. Ex: 17523 has two YT
     for pv_info in data['pVs']:
         if pv_info['service'] == groups[1]:
-            text = ''
-            if inline:
-                text = content_parser(data, info=True, inline=True, bot_name=bot.username)
+            text, keyboard = card(data, lang, inline=True, bot_name=bot.username) if inline else ('', None)
             text += '\n\n' + '🎥'
             text += _('<b>{service} PV for {song} by {artist}</b>\n'
-                      'PV Title:\n{name}\n{url}').format(song=data['name'],
-                                                         artist=data['artistString'],
+                      'PV Title:\n{name}\n{url}').format(song=escape_bad_html(data['name']),
+                                                         artist=escape_bad_html(data['artistString']),
                                                          service=pv_info['service'],
-                                                         name=pv_info['name'],
-                                                         url=pv_info['url'])
+                                                         name=escape_bad_html(pv_info['name']),
+                                                         url=escape_bad_html(pv_info['url']))
             edit_message_text(bot, update, send_if_possible=True,
                               text=text,
-                              reply_markup=song_keyboard(data, inline=True) if inline else None,
+                              reply_markup=keyboard,
                               parse_mode=ParseMode.HTML)
 
             update.callback_query.answer()
@@ -186,6 +215,7 @@ def pv(bot, update, groups, lang):
 
 
 @run_async
+@prioritized(Priority.interactive)
 @translate
 @with_voca_lang
 def album_list(bot, update, groups, lang):
@@ -193,15 +223,13 @@ def album_list(bot, update, groups, lang):
 
     inline = bool(update.callback_query.inline_message_id)
 
-    text = ''
-    if inline:
-        text = content_parser(data, info=True, inline=True, bot_name=bot.username)
+    text, keyboard = card(data, lang, inline=True, bot_name=bot.username) if inline else ('', None)
     text += '\n\n'
     text += album_tracks(data, inline=inline)
 
     edit_message_text(bot, update, send_if_possible=True,
                       text=text,
-                      reply_markup=album_keyboard(data, inline=True) if inline else None,
+                      reply_markup=keyboard,
                       parse_mode=ParseMode.HTML)
     update.callback_query.answer()
 
@@ -215,8 +243,9 @@ def song_by_pv(bot, update, lang):
             pv = pv_parser(update.message.text)
             if pv:
                 data = voca_db.song_by_pv(pv[0], pv[1], 'MainPicture, Names, Lyrics, Artists, PVs', lang=lang)
-                update.message.reply_text(content_parser(data, info=True), reply_markup=song_keyboard(data),
-                                          parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+                text, keyboard = card(data, lang)
+                update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML,
+                                          disable_web_page_preview=True)
 
 
 def forwarded(bot, update, update_queue):
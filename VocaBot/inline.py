@@ -1,20 +1,96 @@
 import os
-import uuid
+import threading
+import time
 from functools import wraps
-from uuid import uuid4
 
 from telegram import InlineQueryResultArticle, InputTextMessageContent, ParseMode
 from telegram.ext.dispatcher import run_async
 
-from contentparser import content_parser
+import prefixindex
+from cache import TTLCache
+from constants import Priority, Context
 from i18n import _
-from info import song_keyboard, artist_keyboard, album_keyboard
-from settings import with_voca_lang, translate, get_setting
-from vocadb import voca_db
-
-ongoing = {}
-MAX_INLINE_RESULTS = 10
+from info import card
+from settings import with_voca_lang, translate, get_setting, get_user, default_settings
+from state import backend
+from vocadb import voca_db, prioritized, list_page
+
+# The first answer is kept small so it shows up fast, scrolling further gets bigger ones (telegram allows up to 50)
+INLINE_FIRST_PAGE = int(os.getenv('VOCABOT_INLINE_FIRST_PAGE', 10))
+INLINE_PAGE = min(int(os.getenv('VOCABOT_INLINE_PAGE', 50)), 50)
 INLINE_CACHE_TIME = int(os.getenv('VOCABOT_INLINE_CACHE_TIME_OVERWRITE', 5 * 60))
+INLINE_ANSWER_CACHE_SIZE = int(os.getenv('VOCABOT_INLINE_ANSWER_CACHE_SIZE', 8 * 1024 * 1024))
+# Seconds to wait for the user to stop typing before searching
+INLINE_DEBOUNCE = float(os.getenv('VOCABOT_INLINE_DEBOUNCE', 0))
+
+# Rendered answers (as dicts), shared by everyone with the same settings
+answers = backend('inline', INLINE_ANSWER_CACHE_SIZE, INLINE_CACHE_TIME)
+# user id -> update id of the newest inline query from them
+latest = TTLCache(100000, ttl=60)
+latest_lock = threading.Lock()
+superseded = 0
+
+
+def is_superseded(update):
+    global superseded
+    if update.update_id < latest.get(update.inline_query.from_user.id, 0):
+        superseded += 1
+        return True
+    return False
+
+
+def drop_superseded(f):
+    """Telegram sends a new inline query for about every key press. Work on a query is dropped as soon as a newer one
+    from the same user has come in, since that's the only one they will ever see."""
+    @wraps(f)
+    def wrapper(bot, update, *args, **kwargs):
+        user_id = update.inline_query.from_user.id
+        # Updates can be handled out of order by the run_async workers
+        with latest_lock:
+            if update.update_id > latest.get(user_id, 0):
+                latest.set(user_id, update.update_id)
+        if INLINE_DEBOUNCE:
+            time.sleep(INLINE_DEBOUNCE)
+        if not is_superseded(update):
+            return f(bot, update, *args, **kwargs)
+
+    return wrapper
+
+
+def answer_key(bot, update, handler, user):
+    query = ' '.join(update.inline_query.query.split()).casefold()
+    return repr((handler, query, user['voca'], user['interface'], user['originals'], update.inline_query.offset,
+                 bot.username))
+
+
+def cached_answer(f):
+    """Answers the query from the answer cache if someone with the same settings asked the same thing lately.
+    Otherwise answer caches what f answers."""
+    @wraps(f)
+    def wrapper(bot, update, *args, **kwargs):
+        user = get_user(bot, update)
+        update.answer_key = answer_key(bot, update, f.__name__, user)
+        # Telegram may only show the answer to others if it doesn't depend on the user's settings
+        update.is_personal = any(user[name] != default for name, default in default_settings.items())
+        cached = answers.get(update.answer_key)
+        if cached is None:
+            return f(bot, update, *args, **kwargs)
+        results, offset, switch_pm = cached
+        send_answer(update, [InlineQueryResultArticle(**{k: v for k, v in result.items() if k != 'type'})
+                             for result in results], offset, switch_pm)
+
+    return wrapper
+
+
+def send_answer(update, results, offset, switch_pm):
+    if is_superseded(update):
+        return
+    update.inline_query.answer(results=results,
+                               cache_time=INLINE_CACHE_TIME,
+                               is_personal=getattr(update, 'is_personal', True),
+                               next_offset=offset,
+                               switch_pm_text=switch_pm[0],
+                               switch_pm_parameter=switch_pm[1])
 
 
 def answer(bot, update, entries, offset='', switch_pm=None):
@@ -22,6 +98,7 @@ def answer(bot, update, entries, offset='', switch_pm=None):
         switch_pm = (_('Click for help.'), 'help_inline')
 
     results = []
+    lang = get_setting('voca', bot, update)
 
     for entry in entries:
         try:
@@ -29,62 +106,48 @@ def answer(bot, update, entries, offset='', switch_pm=None):
         except KeyError:
             thumb = ''
 
-        content = content_parser(entry, info=True, inline=True, bot_name=bot.username)
+        content, keyboard = card(entry, lang, inline=True, bot_name=bot.username)
         if 'songType' in entry:
             description = _('{artist}\n{type} song').format(artist=entry['artistString'], type=entry['songType'])
             if 'favoritedTimes' in entry:
                 description += ' ' + _('with {favorites} favourites').format(favorites=entry['favoritedTimes'])
             results.append(InlineQueryResultArticle(
-                id=uuid4(),
+                id='s-{}'.format(entry['id']),
                 title='🎵' + ' ' + entry['name'],
                 description=description,
                 thumb_url=thumb,
                 input_message_content=InputTextMessageContent(content, parse_mode=ParseMode.HTML,
                                                               disable_web_page_preview=True),
-                reply_markup=song_keyboard(entry, inline=True)
+                reply_markup=keyboard
             ))
         elif 'artistType' in entry:
             results.append(InlineQueryResultArticle(
-                id=uuid4(),
+                id='ar-{}'.format(entry['id']),
                 title='🎤' + ' ' + entry['name'],
                 description='{type}'.format(type=entry['artistType']),
                 thumb_url=thumb,
                 input_message_content=InputTextMessageContent(content, parse_mode=ParseMode.HTML,
                                                               disable_web_page_preview=True),
-                reply_markup=artist_keyboard(entry, inline=True)
+                reply_markup=keyboard
             ))
         elif 'discType' in entry:
             description = '{artist}\n{type}'.format(artist=entry['artistString'], type=entry['discType'])
             results.append(InlineQueryResultArticle(
-                id=uuid4(),
+                id='al-{}'.format(entry['id']),
                 title='💿' + ' ' + entry['name'],
                 description=description,
                 thumb_url=thumb,
                 input_message_content=InputTextMessageContent(content, parse_mode=ParseMode.HTML,
                                                               disable_web_page_preview=True),
-                reply_markup=album_keyboard(entry, inline=True)
+                reply_markup=keyboard
             ))
 
-    update.inline_query.answer(results=results,
-                               cache_time=INLINE_CACHE_TIME,
-                               is_personal=True,
-                               next_offset=offset,
-                               switch_pm_text=switch_pm[0],
-                               switch_pm_parameter=switch_pm[1])
+    key = getattr(update, 'answer_key', None)
+    if key:
+        answers.set(key, ([result.to_dict() for result in results], offset, switch_pm))
+    send_answer(update, results, offset, switch_pm)
 
 
-def delegate_handler(f):
-    @wraps(f)
-    def wrapper(bot, update, *args, **kwargs):
-        if not update.inline_query.offset == '':
-            next_page(bot, update, *args, **kwargs)
-        else:
-            return f(bot, update, *args, **kwargs)
-
-    return wrapper
-
-
-@delegate_handler
 def delegate(bot, update):
     if update.inline_query.query == '':
         top(bot, update)
@@ -93,6 +156,9 @@ def delegate(bot, update):
 
 
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @translate
 @with_voca_lang
 def song_direct(bot, update, groups, lang):
@@ -101,6 +167,9 @@ def song_direct(bot, update, groups, lang):
 
 
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @translate
 @with_voca_lang
 def artist_direct(bot, update, groups, lang):
@@ -109,6 +178,9 @@ def artist_direct(bot, update, groups, lang):
 
 
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @translate
 @with_voca_lang
 def album_direct(bot, update, groups, lang):
@@ -117,77 +189,94 @@ def album_direct(bot, update, groups, lang):
 
 
 def page_wrapper(f):
+    """The offset is the number of results already sent. Telegram sends the same query again for the next ones, so
+    the pager is simply made again from it, nothing has to be remembered in between."""
     @wraps(f)
     def wrapper(bot, update, *args, **kwargs):
+        offset = update.inline_query.offset
+        if offset and not offset.isdigit():
+            # Offset from before paging was stateless
+            answer(bot, update, [], switch_pm=(_('Expired! Please start over.'), 'help_inline'))
+            return
+        offset = int(offset or 0)
         page, switch_pm = f(bot, update, *args, **kwargs)
-        key = str(uuid.uuid4())
-        ongoing[key] = page
-        data = page(1)
-        offset = key + '|2' if data[1][0] + MAX_INLINE_RESULTS < data[1][1] else ''
-        answer(bot, update, data[0], offset=offset, switch_pm=switch_pm)
+        entries, (offset, total), context = page.items(offset, INLINE_PAGE if offset else INLINE_FIRST_PAGE)
+        next_offset = str(offset + len(entries)) if entries and offset + len(entries) < total else ''
+        answer(bot, update, entries, offset=next_offset, switch_pm=switch_pm)
 
     return wrapper
 
 
+def list_pager(entries):
+    """Pager for entries we already have. They are all answered at once, so there is never a next offset: the next
+    query would be answered by another pager, which doesn't have its results in the same order."""
+    def page(i):
+        return list_page(entries, i, INLINE_FIRST_PAGE, Context.search)
+
+    page.items = lambda offset, count: (entries[offset:], (offset, len(entries)), Context.search)
+    return page
+
+
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @page_wrapper
-@delegate_handler
 @translate
 @with_voca_lang
 def top(bot, update, lang):
-    return voca_db.songs('', lang, max_results=MAX_INLINE_RESULTS), None
+    return voca_db.songs('', lang, max_results=INLINE_FIRST_PAGE), None
 
 
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @page_wrapper
-@delegate_handler
 @translate
 @with_voca_lang
 def search(bot, update, lang):
     switch_pm = (_('Searching songs, artists and albums'), 'help_inline')
-    return voca_db.entries(update.inline_query.query, lang, max_results=MAX_INLINE_RESULTS), switch_pm
+    if not update.inline_query.offset:
+        entries = prefixindex.lookup(update.inline_query.query, lang)
+        if entries:
+            return list_pager(entries), switch_pm
+    return voca_db.entries(update.inline_query.query, lang, max_results=INLINE_FIRST_PAGE), switch_pm
 
 
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @page_wrapper
-@delegate_handler
 @translate
 @with_voca_lang
 def song_search(bot, update, groups, lang):
     switch_pm = (_('Searching only songs'), 'help_inline')
-    originals_only = get_setting('originals', bot, update)
-    return voca_db.songs(groups[0], lang, max_results=MAX_INLINE_RESULTS, originals_only=originals_only), switch_pm
+    originals_only = get_setting('originals', bot, update) == 'True'
+    return voca_db.songs(groups[0], lang, max_results=INLINE_FIRST_PAGE, originals_only=originals_only), switch_pm
 
 
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @page_wrapper
-@delegate_handler
 @translate
 @with_voca_lang
 def artist_search(bot, update, groups, lang):
     switch_pm = (_('Searching only artists'), 'help_inline')
-    return voca_db.artists(groups[0], lang, max_results=MAX_INLINE_RESULTS), switch_pm
+    return voca_db.artists(groups[0], lang, max_results=INLINE_FIRST_PAGE), switch_pm
 
 
 @run_async
+@prioritized(Priority.interactive)
+@drop_superseded
+@cached_answer
 @page_wrapper
-@delegate_handler
 @translate
 @with_voca_lang
 def album_search(bot, update, groups, lang):
     switch_pm = (_('Searching only albums'), 'help_inline')
-    return voca_db.albums(groups[0], lang, max_results=MAX_INLINE_RESULTS), switch_pm
-
+    return voca_db.albums(groups[0], lang, max_results=INLINE_FIRST_PAGE), switch_pm
 
-@run_async
-@translate
-@with_voca_lang
-def next_page(bot, update, lang, *args, **kwargs):
-    key, next_i = update.inline_query.offset.split('|')
-    next_i = int(next_i)
-    from_id = update.inline_query.from_user.id
-    query = update.inline_query.query
-
-    data = ongoing[key](next_i)
-    offset = (key + '|' + str(next_i + 1)) if data[1][0] + ((next_i - 1) * MAX_INLINE_RESULTS) < data[1][1] else ''
-    answer(bot, update, data[0], offset=offset)
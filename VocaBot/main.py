@@ -9,9 +9,12 @@ from telegram.ext import (Updater, ConversationHandler, CommandHandler, RegexHan
 import browse
 import info
 import inline
+import prefixindex
 import settings
+import state
 import text
-from constants import BrowseState
+import warmup
+from constants import BrowseState, WARMUP_INTERVAL, PAGER_STORE_SIZE, PAGER_TTL, PREFIX_INDEX_INTERVAL
 from text import cancel
 from util import cancel_callback_query
 from vocadb import voca_db
@@ -22,7 +25,7 @@ logger = logging.getLogger(__name__)
 # TODO: Better error handling
 # TODO: Use bot.send_chat_action?
 # TODO: Handle what stuff should run_async and what should not better
-# TODO: Maybe add a timeout to api and telegram requests too?
+# TODO: Maybe add a timeout to telegram requests too?
 # TODO: Tracking like what botan did
 # TODO: More album integrations 1/2
 # TODO: User login and ratings
@@ -73,6 +76,8 @@ def add_update_handlers(dp):
         fallbacks=[CommandHandler('cancel', cancel)],
         allow_reentry=True
     )
+    if state.SHARED:
+        browse_handler.conversations = state.BackendDict(state.backend('conversations', PAGER_STORE_SIZE, PAGER_TTL))
     # Was inside BrowseState.page state, but we always want paging buttons to work.. even in semi old messages
     browse_page_handler = CallbackQueryHandler(browse.next_page, pattern=r'^(page)\|(.+)\|(.+)$', pass_groups=True)
 
@@ -82,6 +87,7 @@ def add_update_handlers(dp):
     about_handler = CommandHandler('about', text.about)
     privacy_handler = CommandHandler('privacy', text.privacy)
     kill_handler = CommandHandler('kill', text.kill)
+    stats_handler = CommandHandler('stats', text.stats)
     settings_handler = CommandHandler('settings', settings.start)
 
     # TODO: Handle edited_message in these too? (would be nice for eg. /artist pinocchio)
@@ -124,6 +130,7 @@ def add_update_handlers(dp):
     dp.add_handler(about_handler)
     dp.add_handler(privacy_handler)
     dp.add_handler(kill_handler)
+    dp.add_handler(stats_handler)
     dp.add_handler(settings_handler)
 
     dp.add_handler(song_handler)
@@ -170,6 +177,18 @@ def main():
     # Also add our "log everything" error handler
     dp.add_error_handler(error)
 
+    # Copies the settings over from an old TinyDB file if it has to, before anyone waits for them
+    settings.db.open()
+
+    # Fill the caches before taking any updates, then keep them fresh
+    if WARMUP_INTERVAL:
+        warmup.warmup()
+        updater.job_queue.run_repeating(warmup.warmup, interval=WARMUP_INTERVAL, first=WARMUP_INTERVAL)
+    if PREFIX_INDEX_INTERVAL:
+        prefixindex.refresh()
+        updater.job_queue.run_repeating(prefixindex.refresh, interval=PREFIX_INDEX_INTERVAL,
+                                        first=PREFIX_INDEX_INTERVAL)
+
     updater_type = os.getenv('VOCABOT_UPDATER_TYPE', 'POLLING')
     if updater_type == 'POLLING':
         # Start fetching updates
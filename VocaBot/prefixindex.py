@@ -0,0 +1,106 @@
+"""Instant answers for very short inline queries, from the names of everything VocaDB has already sent us.
+
+One, two or three letters is too little for VocaDB to find anything but the usual popular names anyway, so we
+answer those from the songs, artists and albums in the response cache instead. The index maps every prefix of up
+to MAX_PREFIX letters of every name variant (and of every word in it) to the most popular entries starting with it.
+"""
+import logging
+from collections import defaultdict
+from functools import partial
+from urllib.parse import parse_qsl
+
+from settings import VOCADB_LANGUAGES
+from vocadb import voca_db
+
+logger = logging.getLogger(__name__)
+
+MAX_PREFIX = 3
+# All of them are sent in one answer, telegram allows up to 50
+MAX_RESULTS = 10
+# Fields content_parser and the keyboards need to render an inline result
+NEEDED_FIELDS = {
+    'songType': ('name', 'names', 'artistString'),
+    'artistType': ('name', 'names'),
+    'discType': ('name', 'names', 'artistString'),
+}
+
+# lang -> prefix -> entries, most popular first
+index = {}
+
+
+def entries_of(data):
+    if isinstance(data, dict):
+        data = data.get('items', [data])
+    if isinstance(data, list):
+        for entry in data:
+            if isinstance(entry, dict):
+                yield entry
+
+
+def entry_kind(entry):
+    for kind, fields in NEEDED_FIELDS.items():
+        if kind in entry:
+            if all(field in entry for field in fields) and ('pVs' in entry or 'pvServices' in entry or
+                                                            kind != 'songType'):
+                return kind
+            return None
+
+
+def prefixes(entry):
+    for name in {entry['name']} | {name['value'] for name in entry['names']}:
+        name = name.casefold()
+        for word in {name} | set(name.split()):
+            for n in range(1, min(len(word), MAX_PREFIX) + 1):
+                yield word[:n]
+
+
+def build():
+    """Makes a new index from what's in the VocaDB response cache right now."""
+    # lang -> prefix -> (kind, id) -> entry, and how many cached responses each entry was in
+    found = defaultdict(lambda: defaultdict(dict))
+    seen = defaultdict(int)
+    for key, data in voca_db.cache.items():
+        api, __, query = key.partition('?')
+        params = dict(parse_qsl(query))
+        lang = params.get('lang', params.get('languagePreference'))
+        if lang not in VOCADB_LANGUAGES:
+            continue
+        for entry in entries_of(data):
+            kind = entry_kind(entry)
+            if kind is None:
+                continue
+            seen[(lang, kind, entry['id'])] += 1
+            for prefix in prefixes(entry):
+                found[lang][prefix].setdefault((kind, entry['id']), entry)
+
+    def popularity(lang, item):
+        (kind, entry_id), entry = item
+        return seen[(lang, kind, entry_id)], entry.get('favoritedTimes', 0)
+
+    new_index = {}
+    for lang, by_prefix in found.items():
+        new_index[lang] = {prefix: [entry for __, entry in sorted(entries.items(), key=partial(popularity, lang),
+                                                                  reverse=True)[:MAX_RESULTS]]
+                           for prefix, entries in by_prefix.items()}
+    return new_index
+
+
+# noinspection PyUnusedLocal
+def refresh(bot=None, job=None):
+    """Rebuilds the index. Can be used directly or as a job callback."""
+    global index
+    try:
+        index = build()
+    except Exception as e:
+        logger.warning('Could not build prefix index: %s', e)
+
+
+def lookup(query, lang):
+    """The most popular entries with a name starting with query, or None if it's too long or nothing matches."""
+    query = query.strip().casefold()
+    if 0 < len(query) <= MAX_PREFIX:
+        return index.get(lang, {}).get(query)
+
+
+def stats():
+    return {'languages': len(index), 'prefixes': sum(len(by_prefix) for by_prefix in index.values())}
@@ -3,9 +3,8 @@ from functools import wraps
 
 from telegram import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Job
-from tinydb import TinyDB, Query
 
-from constants import DB_FILE
+import settingsdb
 from i18n import _
 from util import id_from_update
 
@@ -20,8 +19,7 @@ SETTINGS_TEXT = _("""<b>Settings for {bot_name}</b>
 VocaDB language is the language used for song and artist titles.
 <i>User</i>&#8201;&#8201;settings are used for private messages and inline requests whereas <i>chat</i>&#8201;&#8201;settings are used in the current group chat.""")
 
-db = TinyDB(str(DB_FILE))
-User = Query()
+db = settingsdb.open_store()
 
 INTERFACE_LANGUAGES = OrderedDict((('en_us', 'English'),))
 VOCADB_LANGUAGES = OrderedDict((('Default', _('Default')),
@@ -50,15 +48,19 @@ def add_setting(name, nice_name, msg, button_text, trans, default):
 def get_user(bot, update):
     global settings, default_settings
     iden = id_from_update(update)
-    user = db.get(User.id == iden)
+    # Only looked up once per update, all the decorators and the handler itself share it
+    resolved = getattr(update, 'user_settings', None)
+    if resolved and resolved[0] == iden:
+        return resolved[1]
+    user = db.get(iden)
     if user is None:
         user = {'id': iden}
-        db.insert(user)
     # Merge with default without overwriting
-    for key, val in default_settings.items():
-        if key not in user:
-            user[key] = val
-    db.update(user, User.id == iden)
+    missing = {key: val for key, val in default_settings.items() if key not in user}
+    if missing:
+        user.update(missing)
+        db.put(user)
+    update.user_settings = (iden, user)
     return user
 
 
@@ -117,7 +119,6 @@ def start(bot, update, edit=False, chat_id=None, message_id=None):
 @translate
 def change_setting(bot, update, setting, data, job_queue):
     user = get_user(bot, update)
-    iden = id_from_update(update)
 
     if data not in settings[setting]['trans']:
         update.callback_query.answer(_('Unknown setting, try again.'))
@@ -127,7 +128,9 @@ def change_setting(bot, update, setting, data, job_queue):
         old = settings[setting]['trans'][user[setting]]
     except KeyError:
         old = _('Corrupted data...')
-    db.update({setting: data}, User.id == iden)
+    if user[setting] != data:
+        user[setting] = data
+        db.put(user)
     new = settings[setting]['trans'][data]
 
     msg_type = _('User') if update.callback_query.message.chat.type == 'private' else _('Chat')
@@ -0,0 +1,263 @@
+"""Where user and chat settings are stored.
+
+The old TinyDB file has to be searched (and rewritten) in full for every lookup, so settings now live in SQLite with
+the user/chat id as primary key. The first time the SQLite store is opened everything in the TinyDB file is copied
+over in one transaction, the file itself is left alone.
+
+Either way recently used settings are kept in memory, and changes are written in batches by a background thread.
+"""
+import atexit
+import codecs
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from cache import TTLCache
+from constants import (DB_FILE, SETTINGS_BACKEND, SETTINGS_DB_FILE, SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL,
+                       SETTINGS_FLUSH_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+
+class TinyDBStore(object):
+    def __init__(self, path):
+        from tinydb import TinyDB, Query
+
+        self.path = path
+        self.db = TinyDB(str(path))
+        self.User = Query()
+
+    def get(self, iden):
+        return self.db.get(self.User.id == iden)
+
+    def put(self, user):
+        self.db.upsert(user, self.User.id == user['id'])
+
+    def put_many(self, users):
+        for user in users:
+            self.put(user)
+
+    def users(self):
+        return tinydb_users(self.path)
+
+
+class SQLiteStore(object):
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, data TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get(self, iden):
+        with self._lock:
+            row = self._db.execute('SELECT data FROM users WHERE id = ?', (iden,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, user):
+        self.put_many([user])
+
+    def put_many(self, users):
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?)',
+                                 ((user['id'], json.dumps(user)) for user in users))
+
+    def users(self, batch_size=1000):
+        """All users, ordered by id. Only batch_size of them are loaded at a time."""
+        last = None
+        while True:
+            with self._lock:
+                rows = self._db.execute('SELECT id, data FROM users WHERE ? IS NULL OR id > ? ORDER BY id LIMIT ?',
+                                        (last, last, batch_size)).fetchall()
+            if not rows:
+                return
+            for last, data in rows:
+                yield json.loads(data)
+
+    def migrated(self):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() is not None
+
+    def migrate(self, users):
+        """Adds users that aren't in the store yet and marks it as migrated, all or nothing. Returns how many were
+        added."""
+        with self._lock, self._db:
+            # Whatever is in the store already was changed after being copied (before the copy was marked as done)
+            before = self._db.total_changes
+            self._db.executemany('INSERT OR IGNORE INTO users VALUES (?, ?)',
+                                 ((user['id'], json.dumps(user)) for user in users))
+            added = self._db.total_changes - before
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', ?)", (str(int(time.time())),))
+        return added
+
+
+class WriteBehindStore(object):
+    """Answers from memory when it can and writes changes to store from a background thread, every interval
+    seconds and when the bot exits. The store isn't opened before it's needed."""
+
+    def __init__(self, open_store, interval):
+        self._open_store = open_store
+        self._store = None
+        self._open_lock = threading.Lock()
+        self.interval = interval
+        self.cache = TTLCache(SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL)
+        self.writes = 0
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        atexit.register(self.flush)
+
+    @property
+    def store(self):
+        with self._open_lock:
+            if self._store is None:
+                self._store = self._open_store()
+            return self._store
+
+    def open(self):
+        """Opens the store now rather than in the first handler that needs it, which would keep every other one
+        waiting while an old TinyDB file is copied."""
+        return self.store
+
+    def get(self, iden):
+        user = self.cache.get(iden)
+        if user is None:
+            with self._lock:
+                pending = self._dirty.get(iden)
+            user = dict(pending) if pending else self.store.get(iden)
+            if user is not None:
+                self.cache.set(iden, user)
+        return user
+
+    def put(self, user):
+        self.cache.set(user['id'], user)
+        with self._lock:
+            self._dirty[user['id']] = dict(user)
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='settings-flusher', daemon=True)
+                self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        try:
+            self.store.put_many(dirty.values())
+            self.writes += len(dirty)
+        except Exception as e:
+            logger.warning('Could not save settings, trying again later: %s', e)
+            with self._lock:
+                for iden, user in dirty.items():
+                    self._dirty.setdefault(iden, user)
+
+    def users(self):
+        self.flush()
+        return self.store.users()
+
+    def stats(self):
+        stats = {'cache_' + name: value for name, value in self.cache.stats().items()}
+        stats.update({'writes': self.writes, 'pending': len(self._dirty)})
+        return stats
+
+
+class JSONStream(object):
+    """Reads JSON values one by one from a file too big to load at once."""
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf, self._pos = '', 0
+
+    def _more(self):
+        chunk = self.f.read(self.chunk_size)
+        self.bytes_read += len(chunk)
+        self._buf = self._buf[self._pos:] + self._text.decode(chunk, final=not chunk)
+        self._pos = 0
+        return bool(chunk)
+
+    def _skip_whitespace(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._more():
+                return
+
+    def at_end(self):
+        self._skip_whitespace()
+        return self._pos == len(self._buf)
+
+    def maybe(self, char):
+        """Skips char if it's next."""
+        self._skip_whitespace()
+        if self._buf.startswith(char, self._pos):
+            self._pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.maybe(char):
+            raise ValueError('Expected {!r} around byte {}'.format(char, self.bytes_read))
+
+    def value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, self._pos = self._decoder.raw_decode(self._buf, self._pos)
+                return value
+            except ValueError:
+                # Probably only half of it has been read yet
+                if not self._more():
+                    raise
+
+
+def tinydb_records(stream):
+    """Yields the records of a TinyDB file, {table: {doc_id: record}}, from a JSONStream of it."""
+    if stream.at_end():
+        return
+    stream.expect('{')
+    while not stream.maybe('}'):
+        stream.value()
+        stream.expect(':')
+        stream.expect('{')
+        while not stream.maybe('}'):
+            stream.value()
+            stream.expect(':')
+            yield stream.value()
+            stream.maybe(',')
+        stream.maybe(',')
+
+
+def tinydb_users(path):
+    """All records in a TinyDB file, read a bit at a time."""
+    with open(str(path), 'rb') as f:
+        yield from tinydb_records(JSONStream(f))
+
+
+def migrate(store, path):
+    count = store.migrate(tinydb_users(path))
+    logger.info('Copied %d users from %s to the settings database', count, path)
+
+
+def open_backend():
+    if SETTINGS_BACKEND == 'tinydb':
+        return TinyDBStore(DB_FILE)
+    store = SQLiteStore(SETTINGS_DB_FILE)
+    if not store.migrated() and DB_FILE.exists():
+        migrate(store, DB_FILE)
+    return store
+
+
+def open_store():
+    return WriteBehindStore(open_backend, SETTINGS_FLUSH_INTERVAL)
@@ -0,0 +1,269 @@
+"""Copies user and chat settings between the TinyDB file, the SQLite database and JSON lines files.
+
+Records are streamed, so memory use doesn't depend on how big the files are, and the bot can keep running while
+its settings are copied. Every record is checked against the settings the bot knows: missing ones get their
+default, unknown values are reset to it and records without a proper id are skipped.
+
+    $ python3 settingsmigrate.py ../data.json ../settings.sqlite
+    $ python3 settingsmigrate.py ../settings.sqlite backup.jsonl
+    $ python3 settingsmigrate.py backup.jsonl ../data.json --force
+
+If a copy is interrupted, running the same command again carries on where the last checkpoint left off.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import settingsdb
+from settings import settings, default_settings
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'.json': 'tinydb', '.jsonl': 'jsonl', '.sqlite': 'sqlite', '.db': 'sqlite'}
+
+
+class TinyDBReader(object):
+    def __init__(self, path):
+        self.f = open(str(path), 'rb')
+        self.stream = settingsdb.JSONStream(self.f)
+
+    @property
+    def bytes_read(self):
+        return self.stream.bytes_read
+
+    def records(self):
+        return settingsdb.tinydb_records(self.stream)
+
+    def close(self):
+        self.f.close()
+
+
+class JSONLinesReader(object):
+    def __init__(self, path):
+        self.f = open(str(path), 'rb')
+        self.bytes_read = 0
+
+    def records(self):
+        for line in self.f:
+            self.bytes_read += len(line)
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self.f.close()
+
+
+class SQLiteReader(object):
+    def __init__(self, path):
+        self.store = settingsdb.SQLiteStore(path)
+        self.bytes_read = 0
+
+    def records(self):
+        for user in self.store.users():
+            # Roughly, there's no file position to go by
+            self.bytes_read += len(json.dumps(user))
+            yield user
+
+    def close(self):
+        pass
+
+
+class FileWriter(object):
+    """Appends to a file, everything after position is thrown away first so an interrupted copy can carry on."""
+
+    def __init__(self, path, position, written):
+        self.f = open(str(path), 'r+b' if position else 'wb')
+        self.f.truncate(position)
+        self.f.seek(position)
+        self.written = written
+
+    @property
+    def position(self):
+        return self.f.tell()
+
+    def write(self, users):
+        self.f.write(''.join(self.encode(user) for user in users).encode('utf-8'))
+        self.written += len(users)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+class JSONLinesWriter(FileWriter):
+    def encode(self, user):
+        return json.dumps(user) + '\n'
+
+
+class TinyDBWriter(FileWriter):
+    """Writes the same {"_default": {"1": {...}, ...}} layout TinyDB does."""
+
+    def __init__(self, path, position, written):
+        super().__init__(path, position, written)
+        if not position:
+            self.f.write(b'{"_default": {')
+        self._doc_id = written
+
+    def encode(self, user):
+        self._doc_id += 1
+        return '{}{}: {}'.format(', ' if self._doc_id > 1 else '', json.dumps(str(self._doc_id)), json.dumps(user))
+
+    def close(self):
+        self.f.write(b'}}')
+        super().close()
+
+
+class SQLiteWriter(object):
+    # Writes are upserts, so redoing some after an interruption is harmless
+    def __init__(self, path, position, written):
+        self.store = settingsdb.SQLiteStore(path)
+        self.position = 0
+        self.written = written
+
+    def write(self, users):
+        self.store.put_many(users)
+        self.written += len(users)
+
+    def close(self):
+        pass
+
+
+READERS = {'tinydb': TinyDBReader, 'jsonl': JSONLinesReader, 'sqlite': SQLiteReader}
+WRITERS = {'tinydb': TinyDBWriter, 'jsonl': JSONLinesWriter, 'sqlite': SQLiteWriter}
+
+
+def format_of(path, given):
+    if given:
+        return given
+    try:
+        return FORMATS[Path(path).suffix]
+    except KeyError:
+        raise SystemExit('Can\'t tell the format of {}, use --source-format or --dest-format'.format(path))
+
+
+def validate(user, counts):
+    """The user with missing or unknown settings set to their default, or None if it isn't a user at all."""
+    if not isinstance(user, dict) or type(user.get('id')) is not int:
+        counts['skipped'] += 1
+        return None
+    for name, default in default_settings.items():
+        if name not in user:
+            user[name] = default
+            counts['filled'] += 1
+        elif user[name] not in settings[name]['trans']:
+            user[name] = default
+            counts['invalid'] += 1
+    return user
+
+
+def load_checkpoint(path, options):
+    try:
+        with open(str(path)) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if checkpoint['source'] != options.source or checkpoint['dest'] != options.dest:
+        raise SystemExit('Checkpoint {} is for copying {} to {}'.format(path, checkpoint['source'],
+                                                                      checkpoint['dest']))
+    return checkpoint
+
+
+def save_checkpoint(path, options, read, writer, counts):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump({'source': options.source, 'dest': options.dest, 'read': read, 'written': writer.written,
+                   'position': writer.position, 'counts': counts}, f)
+    os.replace(tmp, str(path))
+
+
+class Progress(object):
+    """Throughput since the copy (re)started."""
+
+    def __init__(self, read, reader):
+        self.start = time.monotonic()
+        self.reported = 0
+        self.read = read
+        self.reader = reader
+        self.bytes_read = reader.bytes_read
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def throughput(self, read):
+        elapsed = max(self.elapsed(), 1e-9)
+        return '{:.0f} records/s, {:.1f} MB/s'.format((read - self.read) / elapsed,
+                                                     (self.reader.bytes_read - self.bytes_read) / elapsed / 1024 ** 2)
+
+
+def migrate(options):
+    source_format = format_of(options.source, options.source_format)
+    dest_format = format_of(options.dest, options.dest_format)
+    checkpoint_path = options.checkpoint or options.dest + '.checkpoint'
+    checkpoint = load_checkpoint(checkpoint_path, options) if options.resume else None
+    if checkpoint is None and dest_format != 'sqlite' and os.path.exists(options.dest) and not options.force:
+        raise SystemExit('{} already exists, use --force to overwrite it'.format(options.dest))
+
+    read = checkpoint['read'] if checkpoint else 0
+    counts = checkpoint['counts'] if checkpoint else {'skipped': 0, 'filled': 0, 'invalid': 0}
+    reader = READERS[source_format](options.source)
+    writer = WRITERS[dest_format](options.dest, checkpoint['position'] if checkpoint else 0,
+                                  checkpoint['written'] if checkpoint else 0)
+    if checkpoint:
+        logger.info('Resuming after %d records', read)
+
+    batch = []
+    records = reader.records()
+    try:
+        # Records already copied are read again, but not written
+        for __ in zip(range(read), records):
+            pass
+        done = Progress(read, reader)
+        for user in records:
+            read += 1
+            user = validate(user, counts)
+            if user is not None:
+                batch.append(user)
+            if len(batch) >= options.batch:
+                writer.write(batch)
+                batch = []
+                save_checkpoint(checkpoint_path, options, read, writer, counts)
+                if done.elapsed() - done.reported >= options.report_interval:
+                    done.reported = done.elapsed()
+                    logger.info('%d records, %s', read, done.throughput(read))
+        writer.write(batch)
+        writer.close()
+    finally:
+        reader.close()
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    logger.info('Copied %d of %d records from %s to %s in %.1fs, %s. '
+                'Skipped %d, filled in %d missing and reset %d unknown settings.',
+                writer.written, read, options.source, options.dest, done.elapsed(), done.throughput(read),
+                counts['skipped'], counts['filled'], counts['invalid'])
+    return writer.written
+
+
+def parser():
+    p = argparse.ArgumentParser(description='Copy settings between TinyDB, SQLite and JSON lines files.')
+    p.add_argument('source')
+    p.add_argument('dest')
+    p.add_argument('--source-format', choices=sorted(READERS), help='default: guessed from the file extension')
+    p.add_argument('--dest-format', choices=sorted(WRITERS), help='default: guessed from the file extension')
+    p.add_argument('--batch', type=int, default=1000, help='records written (and checkpointed) at a time')
+    p.add_argument('--checkpoint', help='where to keep progress, default: DEST.checkpoint')
+    p.add_argument('--no-resume', dest='resume', action='store_false', help='start over even if there\'s a checkpoint')
+    p.add_argument('--force', action='store_true', help='overwrite an existing TinyDB or JSON lines file')
+    p.add_argument('--report-interval', type=float, default=5, help='seconds between progress reports')
+    return p
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    migrate(parser().parse_args(sys.argv[1:]))
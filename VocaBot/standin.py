@@ -0,0 +1,307 @@
+"""Local stand-in for the VocaDB API, for load testing and benchmarking without hitting vocadb.net.
+
+Responses come from recorded fixtures if there is one for the request, otherwise they are made up on the spot.
+Point the bot at it with VOCABOT_API_ENDPOINT=http://localhost:8090/api/
+
+No recordings are shipped, the made up responses cover every endpoint the VocaDB client uses and have the same
+shape as the real ones. Record some with --record to benchmark against real data, they're saved to the fixtures
+folder.
+
+    $ python3 standin.py --latency 0.05 --error-rate 0.01
+    $ python3 standin.py --record https://vocadb.net/api/   # Record fixtures of everything that's requested
+
+It can also stand in for memcached (just get, set, delete and touch) to try out VOCABOT_STATE_BACKEND with several
+bot processes, without installing the real thing:
+
+    $ python3 standin.py --memcached-port 11211   # VOCABOT_STATE_BACKEND=memcached://localhost:11211
+"""
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, ThreadingTCPServer, StreamRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from urllib.request import urlopen, Request
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_FOLDER = Path(__file__).parent / 'fixtures'
+TOTAL_COUNT = 100
+NAMES = {'Japanese': 'ソング{}', 'Romaji': 'songu {}', 'English': 'Song {}', 'Default': 'ソング{}'}
+SONG_TYPES = ['Original', 'Cover', 'Remix', 'Remaster']
+ARTIST_TYPES = ['Producer', 'Vocaloid', 'Illustrator', 'UTAU']
+DISC_TYPES = ['Album', 'Single', 'EP', 'Compilation']
+
+
+def fixture_path(folder, path, query):
+    """Fixtures are named after the endpoint and a hash of the sorted query, fx. songs_123-0123456789ab.json"""
+    digest = hashlib.sha1(urlencode(sorted(query)).encode()).hexdigest()[:12]
+    return Path(folder) / '{}-{}.json'.format(path.strip('/').replace('/', '_'), digest)
+
+
+def fields_of(params):
+    return {field.strip() for field in params.get('fields', '').split(',')}
+
+
+def entity_name(kind, entity_id, lang):
+    if kind == 'song':
+        return NAMES.get(lang, NAMES['Default']).format(entity_id)
+    return '{} {}'.format(kind.capitalize(), entity_id)
+
+
+def names(kind, entity_id):
+    return [{'language': lang, 'value': entity_name(kind, entity_id, lang)}
+            for lang in ('Japanese', 'Romaji', 'English')]
+
+
+def name(kind, entity_id, params):
+    return entity_name(kind, entity_id, params.get('lang', params.get('languagePreference', 'Default')))
+
+
+def picture(entity_id):
+    return {'urlThumb': 'https://vocadb.net/Content/thumb/{}.jpg'.format(entity_id)}
+
+
+def song(song_id, params):
+    artist_string = 'Producer {} feat. Vocaloid {}'.format(song_id % 50, song_id % 7)
+    data = {'id': song_id, 'name': name('song', song_id, params), 'artistString': artist_string,
+            'songType': SONG_TYPES[song_id % len(SONG_TYPES)], 'favoritedTimes': 1000 - song_id % 1000,
+            'pvServices': 'Youtube, NicoNicoDouga', 'names': names('song', song_id), 'mainPicture': picture(song_id)}
+    fields = fields_of(params)
+    if song_id % 5 == 1:
+        data['originalVersionId'] = song_id - 1
+    if 'Lyrics' in fields:
+        data['lyrics'] = [{'id': song_id * 10 + i, 'cultureCode': code, 'translationType': trans_type,
+                           'value': '\n'.join('Line {} of the lyrics'.format(n) for n in range(40))}
+                          for i, (code, trans_type) in enumerate([('ja', 'Original'), ('', 'Romanized'),
+                                                                  ('en', 'Translation')])]
+    if 'PVs' in fields:
+        data['pVs'] = [{'service': 'Youtube', 'name': data['name'], 'url': 'https://youtu.be/{}'.format(song_id)},
+                       {'service': 'NicoNicoDouga', 'name': data['name'],
+                        'url': 'http://www.nicovideo.jp/watch/sm{}'.format(song_id)}]
+    if 'Artists' in fields:
+        data['artists'] = [{'name': 'Producer {}'.format(song_id % 50), 'effectiveRoles': 'Default',
+                            'categories': 'Producer', 'artist': {'id': song_id % 50}},
+                           {'name': 'Vocaloid {}'.format(song_id % 7), 'effectiveRoles': 'Default',
+                            'categories': 'Vocalist', 'artist': {'id': 1000 + song_id % 7}}]
+    if 'Albums' in fields:
+        data['albums'] = [album(song_id * 10 + i, {'lang': params.get('lang')}) for i in range(song_id % 4)]
+    return data
+
+
+def artist(artist_id, params):
+    return {'id': artist_id, 'name': name('artist', artist_id, params),
+            'artistType': ARTIST_TYPES[artist_id % len(ARTIST_TYPES)], 'names': names('artist', artist_id),
+            'mainPicture': picture(artist_id)}
+
+
+def album(album_id, params):
+    data = {'id': album_id, 'name': name('album', album_id, params), 'artistString': 'Various artists',
+            'discType': DISC_TYPES[album_id % len(DISC_TYPES)], 'names': names('album', album_id),
+            'releaseDate': {'isEmpty': False, 'formatted': '2012-08-31'}, 'mainPicture': picture(album_id)}
+    fields = fields_of(params)
+    if 'Discs' in fields:
+        data['discs'] = [{'discNumber': n, 'mediaType': 'Audio', 'name': 'Disc {}'.format(n)} for n in (1, 2)]
+    if 'Tracks' in fields:
+        data['tracks'] = [{'discNumber': 1 + n // 12, 'trackNumber': 1 + n % 12, 'name': 'Track {}'.format(n),
+                           'song': song(album_id * 100 + n, params)} for n in range(24)]
+    return data
+
+
+def search(make, params, first_id=1):
+    start = int(params.get('start', 0))
+    max_results = int(params.get('maxResults', 10))
+    total = 0 if params.get('query') == 'nothing' else TOTAL_COUNT
+    ids = range(first_id + start, first_id + min(start + max_results, total))
+    return {'items': [make(i, params) for i in ids], 'totalCount': total}
+
+
+def entry(entry_id, params):
+    return [song, artist, album][entry_id % 3](entry_id, params)
+
+
+def related(song_id, params):
+    return {match_type: [song(song_id + i * 5 + j, params) for j in range(1, 6)]
+            for i, match_type in enumerate(('artistMatches', 'likeMatches', 'tagMatches'))}
+
+
+def resources(params):
+    return {set_name: {t: t for t in types} for set_name, types in (('songTypeNames', SONG_TYPES),
+                                                                    ('artistTypeNames', ARTIST_TYPES),
+                                                                    ('discTypeNames', DISC_TYPES))}
+
+
+ROUTES = [
+    (re.compile(r'^entries$'), lambda m, p: search(entry, p)),
+    (re.compile(r'^songs$'), lambda m, p: search(song, p)),
+    (re.compile(r'^artists$'), lambda m, p: search(artist, p)),
+    (re.compile(r'^albums$'), lambda m, p: search(album, p)),
+    (re.compile(r'^songs/top-rated$'), lambda m, p: [song(i, p) for i in range(1, int(p.get('maxResults', 10)) + 1)]),
+    (re.compile(r'^songs/byPv$'), lambda m, p: song(sum(map(ord, p.get('pvId', ''))), p)),
+    (re.compile(r'^songs/(\d+)/derived$'), lambda m, p: [song(int(m.group(1)) * 10 + i, p) for i in range(7)]),
+    (re.compile(r'^songs/(\d+)/related$'), lambda m, p: related(int(m.group(1)), p)),
+    (re.compile(r'^songs/(\d+)$'), lambda m, p: song(int(m.group(1)), p)),
+    (re.compile(r'^artists/(\d+)$'), lambda m, p: artist(int(m.group(1)), p)),
+    (re.compile(r'^albums/(\d+)$'), lambda m, p: album(int(m.group(1)), p)),
+    (re.compile(r'^resources/[\w-]+$'), lambda m, p: resources(p)),
+]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server_version = 'VocaDBStandIn/1.0'
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt, *args)
+
+    def do_GET(self):
+        options = self.server.options
+        time.sleep(options.latency + random.uniform(0, options.jitter))
+        if random.random() < options.error_rate:
+            return self.send(options.error_status, b'')
+
+        url = urlsplit(self.path)
+        if not url.path.startswith('/api/'):
+            return self.send(404, b'')
+        path, query = url.path[len('/api/'):], parse_qsl(url.query)
+
+        body = self.fixture(path, query)
+        if body is None:
+            for pattern, make in ROUTES:
+                match = pattern.match(path)
+                if match:
+                    body = json.dumps(make(match, dict(query)), ensure_ascii=False).encode()
+                    break
+            else:
+                return self.send(404, b'')
+        self.send(200, body)
+
+    def fixture(self, path, query):
+        options = self.server.options
+        fixture = fixture_path(options.fixtures, path, query)
+        if fixture.exists():
+            return fixture.read_bytes()
+        if options.record:
+            request = Request('{}{}?{}'.format(options.record, path, urlencode(query)),
+                              headers={'Accept': 'application/json', 'User-Agent': self.headers['User-Agent']})
+            with urlopen(request) as r:
+                body = r.read()
+            fixture.parent.mkdir(parents=True, exist_ok=True)
+            fixture.write_bytes(body)
+            return body
+
+    def send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, StandInHandler)
+        self.options = options
+
+    @property
+    def endpoint(self):
+        return 'http://{}:{}/api/'.format(*self.server_address[:2])
+
+
+class MemcachedStandInHandler(StreamRequestHandler):
+    def handle(self):
+        store, lock = self.server.store, self.server.lock
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            command, *args = line.split()
+            now = time.time()
+            if command == b'get':
+                with lock:
+                    for key in args:
+                        item = store.get(key)
+                        if item and item[0] > now:
+                            self.wfile.write(b'VALUE %s 0 %d\r\n%s\r\n' % (key, len(item[1]), item[1]))
+                self.wfile.write(b'END\r\n')
+            elif command == b'set':
+                key, __, ttl, length = args[:4]
+                data = self.rfile.read(int(length) + 2)[:-2]
+                with lock:
+                    store[key] = (now + int(ttl) if int(ttl) else float('inf'), data)
+                self.wfile.write(b'STORED\r\n')
+            elif command in (b'delete', b'touch'):
+                with lock:
+                    item = store.pop(args[0], None)
+                    if item and command == b'touch':
+                        store[args[0]] = (now + int(args[1]), item[1])
+                self.wfile.write((b'TOUCHED' if command == b'touch' else b'DELETED') if item else b'NOT_FOUND')
+                self.wfile.write(b'\r\n')
+            else:
+                self.wfile.write(b'ERROR\r\n')
+
+
+class MemcachedStandInServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, MemcachedStandInHandler)
+        # key -> (expires, data)
+        self.store = {}
+        self.lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return 'memcached://{}:{}'.format(*self.server_address[:2])
+
+
+def serve_memcached(host='localhost', port=11211, background=False):
+    server = MemcachedStandInServer((host, port))
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    logger.info('Serving memcached stand-in on %s', server.backend)
+    server.serve_forever()
+
+
+def parser():
+    p = argparse.ArgumentParser(description='Local stand-in for the VocaDB API.')
+    p.add_argument('--host', default='localhost')
+    p.add_argument('--port', type=int, default=8090)
+    p.add_argument('--fixtures', default=str(FIXTURES_FOLDER), help='folder with recorded responses')
+    p.add_argument('--record', metavar='API_URL', help='fetch and save missing fixtures from this API endpoint')
+    p.add_argument('--latency', type=float, default=0, help='seconds to wait before every response')
+    p.add_argument('--jitter', type=float, default=0, help='up to this many extra seconds of random latency')
+    p.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail')
+    p.add_argument('--error-status', type=int, default=503, help='HTTP status of the failed requests')
+    p.add_argument('--memcached-port', type=int, help='also stand in for memcached on this port')
+    return p
+
+
+def serve(*args, background=False):
+    """Starts a stand-in server with the given command line arguments. With background=True it runs in a daemon
+    thread and the server is returned, so benchmarks can use it in-process (port 0 picks a free port)."""
+    options = parser().parse_args(args)
+    server = StandInServer((options.host, options.port), options)
+    if options.memcached_port is not None:
+        server.memcached = serve_memcached(options.host, options.memcached_port, background=True)
+        logger.info('Serving memcached stand-in on %s', server.memcached.backend)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    logger.info('Serving VocaDB stand-in on %s', server.endpoint)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    serve(*sys.argv[1:])
@@ -0,0 +1,193 @@
+"""Where state lives that has to be shared when more than one bot process serves the same token.
+
+By default everything stays in memory, like before. Set VOCABOT_STATE_BACKEND to memcached://host:port (or a comma
+separated list of host:port) to keep it in memcached instead.
+"""
+import abc
+import hashlib
+import logging
+import pickle
+import socket
+import threading
+from collections.abc import MutableMapping
+
+from cache import TTLCache, deep_sizeof
+from constants import STATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+MEMCACHED_TIMEOUT = 1
+# Memcached treats expiry times longer than 30 days as unix timestamps
+MEMCACHED_MAX_TTL = 30 * 24 * 60 * 60
+SHARED = STATE_BACKEND != 'memory'
+
+
+class StateBackend(abc.ABC):
+    """Key-value store with expiry. Keys are strings and values anything picklable."""
+
+    @abc.abstractmethod
+    def get(self, key, default=None):
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class MemoryBackend(StateBackend):
+    def __init__(self, max_size, ttl, idle=False):
+        self.cache = TTLCache(max_size, ttl=ttl, idle=idle)
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl=ttl, size=deep_sizeof((key, value)))
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class MemcachedConnection(object):
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, timeout=MEMCACHED_TIMEOUT)
+        self.f = self.sock.makefile('rb')
+
+    def command(self, line, data=None):
+        """Sends a command and returns the first line of the reply."""
+        self.sock.sendall(line + b'\r\n' + (data + b'\r\n' if data is not None else b''))
+        return self.f.readline().rstrip(b'\r\n')
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+
+class MemcachedBackend(StateBackend):
+    """Speaks the memcached text protocol. Every thread gets its own connection to each server."""
+
+    def __init__(self, servers, namespace, ttl):
+        self.servers = [(host, int(port)) for host, __, port in (s.rpartition(':') for s in servers)]
+        self.namespace = namespace
+        self.ttl = ttl
+        self._local = threading.local()
+        self.hits, self.misses, self.errors = 0, 0, 0
+
+    def _key(self, key):
+        # Memcached keys can't be longer than 250 bytes or contain whitespace
+        return '{}:{}'.format(self.namespace, hashlib.sha1(key.encode()).hexdigest()).encode()
+
+    def _address(self, key):
+        return self.servers[int(key[-8:], 16) % len(self.servers)]
+
+    def _connection(self, address):
+        connections = self._local.__dict__.setdefault('connections', {})
+        if address not in connections:
+            connections[address] = MemcachedConnection(address)
+        return connections[address]
+
+    def _run(self, key, f):
+        """Runs f(connection), reconnecting once if the connection broke. Failures are logged and give None."""
+        address = self._address(key)
+        for attempt in range(2):
+            try:
+                return f(self._connection(address))
+            except (OSError, ValueError) as e:
+                # There's nothing to drop if the server couldn't be reached at all
+                broken = self._local.connections.pop(address, None)
+                if broken is not None:
+                    broken.close()
+                if attempt:
+                    logger.warning('Memcached request to %s:%s failed: %s', *address, e)
+                    self.errors += 1
+
+    def get(self, key, default=None):
+        key = self._key(key)
+
+        def get(connection):
+            line = connection.command(b'get ' + key)
+            if line == b'END':
+                return None
+            __, __, __, length = line.split()
+            data = connection.f.read(int(length) + 2)[:-2]
+            if connection.f.readline() != b'END\r\n':
+                raise ValueError('Unexpected reply to get')
+            return data
+
+        data = self._run(key, get)
+        if data is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        key = self._key(key)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        ttl = min(int(self.ttl if ttl is None else ttl) or 1, MEMCACHED_MAX_TTL)
+        line = b'set %s 0 %d %d' % (key, ttl, len(data))
+        reply = self._run(key, lambda connection: connection.command(line, data))
+        if reply is not None and reply != b'STORED':
+            # Fx. SERVER_ERROR object too large for cache
+            logger.debug('Memcached did not store %s: %s', key, reply)
+
+    def delete(self, key):
+        key = self._key(key)
+        self._run(key, lambda connection: connection.command(b'delete ' + key))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
+
+
+class BackendDict(MutableMapping):
+    """Dict-like view of a backend for ConversationHandler.conversations.
+
+    Conversation keys are tuples of ids. States that are still waiting for a run_async Promise can't leave the
+    process, those are kept locally until they are resolved. Iterating only sees the local ones.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._local = {}
+
+    def __getitem__(self, key):
+        if key in self._local:
+            return self._local[key]
+        value = self.backend.get(repr(key))
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if isinstance(value, tuple):
+            self._local[key] = value
+        else:
+            self._local.pop(key, None)
+            self.backend.set(repr(key), value)
+
+    def __delitem__(self, key):
+        self._local.pop(key, None)
+        self.backend.delete(repr(key))
+
+    def __iter__(self):
+        return iter(self._local)
+
+    def __len__(self):
+        return len(self._local)
+
+
+def backend(namespace, max_size, ttl, idle=False):
+    """The configured backend. In memory it's bounded by max_size bytes, idle works like it does for TTLCache."""
+    if STATE_BACKEND.startswith('memcached://'):
+        return MemcachedBackend(STATE_BACKEND[len('memcached://'):].split(','), namespace, ttl)
+    return MemoryBackend(max_size, ttl, idle=idle)
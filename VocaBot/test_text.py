@@ -0,0 +1,15 @@
+from types import SimpleNamespace
+
+import text
+from constants import OWNER_IDS
+
+
+def test_stats():
+    replies = []
+    message = SimpleNamespace(from_user=SimpleNamespace(id=OWNER_IDS[0]),
+                              reply_text=lambda reply, **kwargs: replies.append(reply))
+    # Without the interface language lookup, that needs the settings database
+    text.stats.__wrapped__(None, SimpleNamespace(message=message))
+    assert len(replies) == 1
+    for name in ('inline_answers_', 'inline_superseded', 'browse_', 'cards_', 'prefix_index_', 'settings_'):
+        assert name in replies[0], name
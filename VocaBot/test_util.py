@@ -0,0 +1,97 @@
+import random
+import re
+
+from util import split
+
+SEPS = ('\n\n', '\n', ' ')
+TAG = re.compile(r'<(/?)([a-z]+)[^<>]*>')
+ENTITY = re.compile(r'&(?:#\d+|#x[0-9a-fA-F]+|[a-zA-Z]+);')
+
+
+def visible(text):
+    """What telegram shows of text, with every entity as a single character."""
+    return ENTITY.sub('\0', TAG.sub('', text))
+
+
+def formatted(r, depth=0):
+    """Random text with nested tags and entities, like the bot's messages."""
+    out = []
+    for __ in range(r.randint(1, 30)):
+        x = r.random()
+        if x < .5:
+            out.append(r.choice(['word', 'ab', 'x' * r.randint(1, 30), '日本語']))
+        elif x < .7:
+            out.append(r.choice(SEPS))
+        elif x < .8:
+            out.append(r.choice(['&amp;', '&#8201;', '&', '&lt;']))
+        elif depth < 3:
+            name = r.choice(['b', 'i', 'code', 'a'])
+            tag = '<a href="https://t.me/VocaDBBot?start=cmd%3Dinfo_1">' if name == 'a' else '<{}>'.format(name)
+            out.append(tag + formatted(r, depth + 1) + '</{}>'.format(name))
+    return ''.join(out)
+
+
+def lyrics(r, lines):
+    return '\n'.join(' '.join(r.choice(['ai', 'kokoro', 'sekai', 'yume', 'x' * r.randint(1, 12)])
+                              for __ in range(r.randint(1, 8)))
+                     for __ in range(lines))
+
+
+def check_balanced(piece):
+    names = []
+    for closing, name in TAG.findall(piece):
+        if closing:
+            assert names and names.pop() == name, piece
+        else:
+            names.append(name)
+    assert not names, piece
+
+
+def check_joins(text, pieces):
+    """The pieces put back together with one of the separators between each are the text again."""
+    positions = {0}
+    for piece in pieces:
+        found = set()
+        for pos in positions:
+            if text.startswith(piece, pos):
+                pos += len(piece)
+                found.update(pos + len(sep) for sep in ('',) + SEPS if text.startswith(sep, pos))
+        positions = found
+    assert len(text) in positions, (text, pieces)
+
+
+def test_split_formatted():
+    r = random.Random(0)
+    for __ in range(3000):
+        text = formatted(r)
+        max_length, max_formatting = r.randint(1, 60), r.randint(1, 6)
+        pieces = list(split(text, max_length, SEPS, max_formatting=max_formatting))
+        for piece in pieces:
+            check_balanced(piece)
+            assert len(visible(piece)) <= max_length, (text, piece)
+        check_joins(visible(text), [visible(piece) for piece in pieces])
+
+
+def test_split_max_formatting():
+    r = random.Random(1)
+    for __ in range(1000):
+        text = ''.join(r.choice(['<b>x</b> ', 'word ', '<code>c</code>\n']) for __ in range(r.randint(1, 200)))
+        max_formatting = r.randint(1, 10)
+        for piece in split(text, 4095, SEPS, max_formatting=max_formatting):
+            assert piece.count('</') <= max_formatting, (piece, max_formatting)
+
+
+def test_split_lyrics():
+    r = random.Random(2)
+    for __ in range(1000):
+        text = lyrics(r, r.randint(1, 60))
+        max_length = r.randint(15, 200)
+        pieces = list(split(text, max_length, SEPS))
+        assert all(0 < len(piece) <= max_length for piece in pieces), pieces
+        check_joins(text, pieces)
+
+
+def test_split_short():
+    assert list(split('', 10, SEPS)) == []
+    assert list(split('<b>a</b> &amp; b', 5, SEPS)) == ['<b>a</b> &amp; b']
+    assert list(split('<b>aaa bbb</b>', 4, SEPS)) == ['<b>aaa</b>', '<b>bbb</b>']
@@ -5,9 +5,15 @@ from urllib.parse import unquote
 from telegram import ParseMode
 from telegram.ext import ConversationHandler
 
+import browse
+import info
+import inline as inline_mode
+import prefixindex
+import settings
 from constants import __version__, OWNER_IDS
 from i18n import _
 from settings import translate
+from vocadb import voca_db
 
 BASE_START_TEXT = _("""Hello {user_name}! I'm {bot_name}.
 I use VocaDB.net to find all your favourite Vocaloid songs, artists and albums.
@@ -121,6 +127,22 @@ def kill(bot, update):
         update.message.reply_text(_("I can't let you do that, dave."))
 
 
+@translate
+def stats(bot, update):
+    if update.message.from_user.id in OWNER_IDS:
+        stats = voca_db.stats()
+        stats.update({'browse_' + name: value for name, value in browse.ongoing.stats().items()})
+        stats.update({'inline_answers_' + name: value for name, value in inline_mode.answers.stats().items()})
+        stats.update({'cards_' + name: value for name, value in info.cards.stats().items()})
+        stats['inline_superseded'] = inline_mode.superseded
+        stats.update({'prefix_index_' + name: value for name, value in prefixindex.stats().items()})
+        stats.update({'settings_' + name: value for name, value in settings.db.stats().items()})
+        text = '\n'.join('{}: <code>{}</code>'.format(name, value) for name, value in sorted(stats.items()))
+        update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    else:
+        update.message.reply_text(_("I can't let you do that, dave."))
+
+
 @translate
 def unknown(bot, update):
     if update.message.chat.type == 'private':
@@ -1,6 +1,8 @@
 import os
 import re
+from bisect import bisect_left, bisect_right
 from functools import wraps
+from itertools import chain, islice
 
 import iso639
 from telegram.constants import MAX_MESSAGE_LENGTH
@@ -33,6 +35,13 @@ PV_PATTERNS = {
 PV_PATTERNS = {k: [re.compile(s) for s in v] for k, v in PV_PATTERNS.items()}
 
 
+def escape_bad_html(text):
+    # text = text.replace('&', '&#38;')
+    text = text.replace('<', '&lt;')
+    text = text.replace('>', '&gt;')
+    return text
+
+
 def cancel_callback_query(bot, update):
     bot.answer_callback_query(callback_query_id=update.callback_query.id)
 
@@ -71,51 +80,164 @@ def id_from_update(update):
         return user.id
 
 
+# Plain text up to the next tag, and the tag. A < that doesn't start one is plain text too.
+TAG_RUNS = re.compile(r'([^<]*)(<(/?)([a-zA-Z]+)[^<>]*>|<|$)')
+ENTITY_RUNS = re.compile(r'([^&]*)(&(?:#\d+|#x[0-9a-fA-F]+|[a-zA-Z]+);|&|$)')
+NO_ENTITY = (float('inf'), 0)
+
+
+def entities(text):
+    """(start, end) of every HTML entity in text, then NO_ENTITY."""
+    # They can only be between the first & and the last ;, re doesn't have to go through the rest
+    pos = max(text.find('&'), 0)
+    for plain, entity in ENTITY_RUNS.findall(text, pos, text.rfind(';') + 1):
+        pos += len(plain)
+        if len(entity) > 1:
+            yield pos, pos + len(entity)
+        pos += len(entity)
+    yield NO_ENTITY
+
+
+def markup(text):
+    """Goes through the tags and entities in text once. Returns their starts and ends, how many visible characters
+    and opening tags there are up to the end of each, and the tags that are open after each one. Open tags are
+    (name, tag, outer tags) links, so keeping track of them doesn't copy anything."""
+    starts, ends, visibles, openeds, stacks = [], [], [], [], []
+    visible = opened = last = 0
+    tags = None
+    amps = entities(text)
+    amp = next(amps)
+    # Same as for entities, tags are between the first < and the last >
+    pos = max(text.find('<'), 0)
+    for plain, tag, closing, name in TAG_RUNS.findall(text, pos, max(text.rfind('>') + 1, pos)):
+        pos += len(plain)
+        if not tag:
+            # Only the entities after the last tag are left
+            pos = len(text)
+        elif len(tag) == 1:
+            pos += 1
+            continue
+        while amp[0] < pos:
+            # The ones inside a tag are part of it
+            if amp[0] >= last:
+                visible += amp[0] - last + 1
+                last = amp[1]
+                starts.append(amp[0])
+                ends.append(last)
+                visibles.append(visible)
+                openeds.append(opened)
+                stacks.append(tags)
+            amp = next(amps)
+        if not tag:
+            break
+        if not closing:
+            tags = (name, tag, tags)
+            opened += 1
+        elif tags:
+            if tags[0] == name or tags[0].lower() == name.lower():
+                tags = tags[2]
+            else:
+                # Closes everything opened after it too
+                outer = tags[2]
+                while outer and outer[0].lower() != name.lower():
+                    outer = outer[2]
+                if outer:
+                    tags = outer[2]
+        visible += pos - last
+        last = pos + len(tag)
+        starts.append(pos)
+        ends.append(last)
+        visibles.append(visible)
+        openeds.append(opened)
+        stacks.append(tags)
+        pos = last
+    return starts, ends, visibles, openeds, stacks
+
+
+def open_tags(tags):
+    """The links of tags, outermost first."""
+    found = []
+    while tags:
+        found.append(tags)
+        tags = tags[2]
+    return found[::-1]
+
+
 # By @bomjacob
-# Still not 100% foolproof... fx. doesn't work properly if formatting tags are multiline i don't think
-# If anyone wants to improve go ahead!
-# TODO: Filter out tags for len()s?
 def split(text, max_length, seps, max_formatting=99):
-    """Splits text into pieces of max_lengths, but only on specified separators.
-    :param max_formatting: Maximum count of formatting entities in a piece.
+    """Lazily splits text into pieces of at most max_length visible characters (tags don't count, entities count as
+    one), but only on the specified separators if it can. Formatting tags that are open where the text is split are
+    closed at the end of the piece and opened again at the start of the next one.
+    :param max_formatting: Maximum count of formatting entities (tags) in a piece.
     :param seps: A tuple of separators, from most desired to least desired.
     :param max_length: Maximum length of pieces
     :param text: The text to split
     """
-    pieces, i = [], 0
-    while i < len(text):
-        piece = text[i:i + max_length]
-        if piece.count('<code>') + piece.count('<b>') + piece.count('<a>') > max_formatting:
-            # Find place of nth occurrence in string
-            for l, match in enumerate(re.finditer(r'(<code>|<b>|<a>)', piece)):
-                if l == max_formatting:
-                    piece = piece[0:match.end(1)]
-        if i + len(piece) >= len(text):
-            pieces.append(piece)
-            break
-        for j, sep in enumerate(seps):
-            before, __, after = piece.rpartition(sep)
-            if before == '':
-                # Last separator?
-                if j == len(seps) - 1:
-                    pieces.append(after)
-                    i += len(after) + len(sep)
+    starts, ends, visible, opened, stacks = markup(text)
+    count = len(starts)
+
+    def visible_at(pos):
+        k = bisect_right(ends, pos) - 1
+        return visible[k] + pos - ends[k] if k >= 0 else pos
+
+    start, tags = 0, ()
+    while start < len(text):
+        first = bisect_left(starts, start)
+        # Where the piece would end going by its visible length
+        most = visible_at(start) + max_length
+        k = bisect_right(visible, most, first)
+        if k < count:
+            before = visible[k - 1] + starts[k] - ends[k - 1] if k else starts[k]
+            limit = starts[k] - (before - most)
+        else:
+            left = visible_at(len(text)) - most
+            limit = len(text) - left if left > 0 else None
+        # And going by the number of formatting tags, though one is always let in so there's some progress
+        allowed = (opened[first - 1] if first else 0) + max(max_formatting - len(tags), 0)
+        k = bisect_right(opened, allowed, first)
+        if k < count and starts[k] == start:
+            k = bisect_right(opened, opened[k], k + 1)
+        if k < count and (limit is None or starts[k] < limit):
+            limit = starts[k]
+        if limit is None:
+            yield ''.join(tag for __, tag, __ in tags) + text[start:]
+            return
+
+        # Too long, split at the most desired separator there is in the piece or right at the limit if there's none
+        cut = resume = limit
+        for sep in seps:
+            end = limit
+            while True:
+                i = text.rfind(sep, start + 1, end)
+                k = bisect_right(starts, i) - 1
+                if i != -1 and k >= 0 and ends[k] > i:
+                    # Inside a tag
+                    end = starts[k]
+                elif i != -1 and k + 1 < count and i + len(sep) > starts[k + 1]:
+                    # Runs into a tag
+                    end = starts[k + 1]
+                else:
                     break
-            else:
-                pieces.append(before)
-                i += len(before) + len(sep)
+            if i != -1:
+                cut, resume = i, i + len(sep)
                 break
-    return pieces
+        k = bisect_left(starts, cut) - 1
+        closing = open_tags(stacks[k]) if k >= 0 else ()
+        yield (''.join(tag for __, tag, __ in tags) + text[start:cut] +
+               ''.join('</{}>'.format(name.lower()) for name, __, __ in reversed(closing)))
+        start, tags = resume, closing
 
 
 def edit_message_text(bot, update, *args, send_if_possible=False, text='', **kwargs):
     if update.callback_query.message:
         pieces = split(text, MAX_MESSAGE_LENGTH - 1, seps=('\n\n', '\n', ' '))
-        if len(pieces) > 1:
+        # Only the first two are needed to know if it has to be split
+        first = list(islice(pieces, 2))
+        if len(first) > 1:
             bot.answer_callback_query(callback_query_id=update.callback_query.id,
                                       text=_('Message too long to send. Attempting to send in pieces.'),
                                       show_alert=True)
-        for piece in pieces:
+        for piece in chain(first, pieces):
             if send_if_possible:
                 bot.send_message(chat_id=update.callback_query.message.chat.id, *args, text=piece, **kwargs)
             else:
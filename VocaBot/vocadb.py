@@ -1,220 +1,761 @@
-import json
+import heapq
+import itertools
 import logging
-
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlencode, parse_qsl
+
+import aiohttp
 import requests
-from cachecontrol import CacheControl
-from cachecontrol.heuristics import ExpiresAfter
+import ujson
 
-from constants import VOCADB_API_ENDPOINT, VOCADB_USER_AGENT, Context
+import state
+from cache import TTLCache, DiskCache
+from constants import (VOCADB_API_ENDPOINT, VOCADB_USER_AGENT, VOCADB_CACHE_SIZE, VOCADB_BLOCK_SIZE, VOCADB_RETRIES,
+                       VOCADB_RATE_LIMIT, VOCADB_RATE_BURST, DISK_CACHE_FILE, Context, Priority)
 from i18n import _
 
 logger = logging.getLogger(__name__)
 
+# Entities and translations hardly ever change, but anything sorted by date or rating does
+CACHE_TTLS = [
+    (re.compile(r'^resources/'), 24 * 60 * 60),
+    (re.compile(r'^(songs|artists|albums)/\d+$'), 6 * 60 * 60),
+    (re.compile(r'^songs/byPv$'), 6 * 60 * 60),
+    (re.compile(r'^songs/top-rated$'), 10 * 60),
+]
+CACHE_TTL_ADDITION_DATE = 5 * 60
+CACHE_TTL_DEFAULT = 60 * 60
+# (connect, read) timeouts in seconds. Lists and translations can be big, so they get a bit longer to read.
+TIMEOUTS = [
+    (re.compile(r'^resources/'), (3.05, 20)),
+    (re.compile(r'^songs/\d+/(derived|related)$'), (3.05, 15)),
+    (re.compile(r'^songs/top-rated$'), (3.05, 15)),
+]
+TIMEOUT_DEFAULT = (3.05, 10)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF = 0.25
+ENTITY_API = re.compile(r'^(songs|artists|albums)/\d+$')
+# Max number of entities we remember the fetched fields of
+ENTITY_INDEX_SIZE = 100000
+# What's left of list entries kept by the listing pagers
+COMPACT_FIELDS = ('id', 'name', 'artistString', 'songType', 'artistType', 'discType', 'favoritedTimes')
+RELATED_MATCH_TYPES = ('artistMatches', 'likeMatches', 'tagMatches')
+# What VocaDB calls the translations of each type, album types are disc types over there
+RESOURCE_SETS = {'song': 'songTypeNames', 'artist': 'artistTypeNames', 'album': 'discTypeNames'}
+
+
+def parse_response(body):
+    # Straight from the raw bytes. Escaping for telegram is done when rendering, see util.escape_bad_html
+    try:
+        return ujson.loads(body)
+    except ValueError as e:
+        logger.warning('Non-JSON returned from VocaDB API endpoint: %s', e)
+        return None
+
+
+def search_block_size(max_results):
+    """Rounds VOCADB_BLOCK_SIZE up to a whole number of pages."""
+    return max(1, math.ceil(VOCADB_BLOCK_SIZE / max_results)) * max_results
+
+
+def block_page(block, offset, max_results):
+    start, items, total = block
+    return items[offset - start:offset - start + max_results], (offset, total), Context.search
+
+
+def block_covers(block, offset, count):
+    """If the results offset to offset + count (or to the end of them) are all in the block."""
+    if block is None:
+        return False
+    start, items, total = block
+    return start <= offset and (offset + count <= start + len(items) or start + len(items) >= total)
+
+
+def page_block(block, offset, block_size):
+    """(start, count) of the block the page at offset is in, or None if that's the one fetched already."""
+    start = offset - offset % block_size
+    if block is None or block[0] != start:
+        return start, block_size
+    return None
+
+
+def items_block(block, offset, count, block_size):
+    """(start, count) of the block to fetch for any number of results from any offset, in one request, or None if the
+    fetched one has them all."""
+    if block_covers(block, offset, count):
+        return None
+    return offset, max(count, block_size)
+
+
+def new_block(start, data):
+    return start, data['items'], data['totalCount']
+
+
+def entries_payload(query, lang, sort):
+    return {'query': query, 'lang': lang, 'fields': 'MainPicture, Names, PVs', 'sort': sort}
+
+
+def songs_payload(query, lang, sort, artist_id, originals_only):
+    payload = {'query': query, 'lang': lang, 'fields': 'MainPicture, Names, Artists', 'sort': sort,
+               'artistId': artist_id}
+    if originals_only:
+        payload.update({'songTypes': 'Original'})
+    return payload
+
+
+def artists_payload(query, lang, sort):
+    return {'query': query, 'lang': lang, 'fields': 'MainPicture, Names', 'sort': sort}
+
+
+def albums_payload(query, lang, sort, artist_id):
+    return {'query': query, 'lang': lang, 'fields': 'MainPicture, Names', 'sort': sort, 'artistId': artist_id}
+
+
+def top_rated_payload(lang, max_results, hours):
+    # Get max 10 pages
+    return {'durationHours': hours, 'languagePreference': lang, 'fields': 'MainPicture, Names, Artists',
+            'maxResults': 10 * max_results, 'filterBy': 'PublishDate'}
+
+
+def song_list_payload(lang):
+    """For derived and related songs."""
+    return {'fields': 'MainPicture', 'lang': lang}
+
+
+def pv_payload(service, pv_id, fields, lang):
+    return {'pvService': service, 'pvId': pv_id, 'fields': fields, 'lang': lang}
+
+
+def list_page(data, i, max_results, context):
+    if data:
+        offset = (i - 1) * max_results
+        return data[offset:offset + max_results], (offset, len(data)), context
+    return [], (0, 0), context
+
+
+def compact(entries):
+    """Strips list entries down to what content_parser needs for a search style listing."""
+    if entries is None:
+        return None
+    return [{key: entry[key] for key in COMPACT_FIELDS if key in entry} for entry in entries]
+
+
+def related_page(data, i):
+    if data:
+        r = []
+        smallest = 100
+        for match_type in RELATED_MATCH_TYPES:
+            if not data[match_type]:
+                break
+            r.append(data[match_type][i - 1])
+            smallest = len(data[match_type]) if len(data[match_type]) < smallest else smallest
+        else:
+            return r, ((i - 1) * 3, smallest * 3), Context.related
+    return [], (0, 0), Context.related
+
+
+def query_params(params):
+    """Flattens a requests style params dict into a list of string pairs that aiohttp accepts."""
+    flat = []
+    for key, value in params.items():
+        if value is None:
+            continue
+        for v in (value if isinstance(value, (list, tuple)) else [value]):
+            flat.append((key, str(v)))
+    return flat
+
+
+def by_endpoint(rules, api, default):
+    for pattern, value in rules:
+        if pattern.match(api):
+            return value
+    return default
+
 
-def escape_bad_html(text):
-    # text = text.replace('&', '&#38;')
-    text = text.replace('<', '&lt;')
-    text = text.replace('>', '&gt;')
-    return text
+def cache_ttl(api, params):
+    if params.get('sort') == 'AdditionDate':
+        return CACHE_TTL_ADDITION_DATE
+    return by_endpoint(CACHE_TTLS, api, CACHE_TTL_DEFAULT)
+
+
+def backoff(attempt):
+    # Exponential with full jitter, so retries from many threads don't all hit at once
+    return random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+
+
+def split_fields(fields):
+    return frozenset(field.strip() for field in fields.split(',') if field.strip())
+
+
+def request_key(api, params):
+    """Normalizes an api call into a string key. Field lists are sorted since VocaDB doesn't care about their order."""
+    normalized = []
+    for key, value in query_params(params):
+        if key in ('fields', 'setNames'):
+            value = ','.join(sorted(v.strip() for v in value.split(',')))
+        normalized.append((key, value))
+    return api + '?' + urlencode(sorted(normalized))
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Makes concurrent callers with the same key share a single call instead of each making their own."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, f):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = f()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class VocaDBUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Stops calls to VocaDB for a while once too many of the recent ones have failed.
+
+    After the cooldown a single trial call is let through, if that succeeds everything goes back to normal.
+    """
+
+    def __init__(self, threshold=0.5, window=20, min_calls=10, cooldown=30):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.opened = 0
+        self._results = deque(maxlen=window)
+        self._open_until = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._open_until is None:
+            return 'closed'
+        return 'open' if time.monotonic() < self._open_until else 'half-open'
+
+    def allow(self):
+        with self._lock:
+            if self._open_until is None:
+                return True
+            if time.monotonic() < self._open_until or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, success):
+        with self._lock:
+            if self._open_until is not None:
+                # Result of the trial call
+                self._trial = False
+                if success:
+                    self._open_until = None
+                    self._results.clear()
+                else:
+                    self._open_until = time.monotonic() + self.cooldown
+                return
+            self._results.append(success)
+            failures = self._results.count(False)
+            if len(self._results) >= self.min_calls and failures / len(self._results) >= self.threshold:
+                logger.warning('Too many failed VocaDB requests, pausing them for %s seconds.', self.cooldown)
+                self._open_until = time.monotonic() + self.cooldown
+                self.opened += 1
+
+
+class RateLimiter(object):
+    """Token bucket for outgoing requests. Once it runs dry, waiting requests get the next tokens in priority order,
+    oldest first within the same priority."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+        # priority -> [count, total wait, max wait]
+        self.waits = {priority: [0, 0.0, 0.0] for priority in Priority}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority):
+        if not self.rate:
+            return
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority.value, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                self._refill()
+                if self._waiting[0] == ticket:
+                    if self._tokens >= 1:
+                        break
+                    self._cond.wait((1 - self._tokens) / self.rate)
+                else:
+                    self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self._cond.notify_all()
+
+            waited = time.monotonic() - start
+            stats = self.waits[priority]
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+
+    def stats(self):
+        stats = {'queued': len(self._waiting)}
+        for priority, (count, total, longest) in self.waits.items():
+            stats['{}_requests'.format(priority.name)] = count
+            stats['{}_wait_avg_ms'.format(priority.name)] = round(total / count * 1000, 1) if count else 0
+            stats['{}_wait_max_ms'.format(priority.name)] = round(longest * 1000, 1)
+        return stats
 
 
 class VocaDB(object):
     def __init__(self):
         self.s = requests.Session()
-        # We cache ALL responses for 60 min. so eg. inline lyrics request don't make two calls right after each other.
-        # This MAY have unforeseen consequences, but hopefully we can deal with those.
-        self.s = CacheControl(self.s, cache_etags=False, heuristic=ExpiresAfter(minutes=60))
+        # We cache ALL parsed responses so eg. inline lyrics request don't make two calls right after each other.
+        # How long depends on the endpoint, see CACHE_TTLS.
+        self.cache = TTLCache(VOCADB_CACHE_SIZE, ttl=CACHE_TTL_DEFAULT)
+        # (api, lang) -> set of fields, so a request for some fields can reuse a cached response with more of them
+        self.entity_fields = TTLCache(ENTITY_INDEX_SIZE, ttl=cache_ttl('songs/0', {}))
+        self.entity_hits, self.entity_upgrades = 0, 0
+        # Entity lookups can also be kept on disk, so a restarted bot doesn't start from scratch
+        self.disk_cache = None
+        if DISK_CACHE_FILE:
+            self.disk_cache = DiskCache(DISK_CACHE_FILE)
+            self.disk_cache.purge()
+            for key, data, ttl, size in self.disk_cache.items(VOCADB_CACHE_SIZE // 2):
+                self.cache.set(key, data, ttl=ttl, size=size)
+                api, __, query = key.partition('?')
+                params = dict(parse_qsl(query))
+                if ENTITY_API.match(api) and 'fields' in params:
+                    self.remember_fields(api, params['lang'], split_fields(params['fields']), ttl=ttl)
+        # Other bot processes' responses, when there are any
+        self.shared_cache = state.backend('vocadb', VOCADB_CACHE_SIZE, CACHE_TTL_DEFAULT) if state.SHARED else None
         self.s.headers.update({'Accept': 'application/json', 'User-Agent': VOCADB_USER_AGENT})
         self.opts = {'nameMatchMode': 'Auto', 'getTotalCount': 'true'}
         self._resources = {}
+        self.in_flight = SingleFlight()
+        self.breaker = CircuitBreaker()
+        self.retries, self.stale = 0, 0
+        self.limiter = RateLimiter(VOCADB_RATE_LIMIT, VOCADB_RATE_BURST)
+        self._local = threading.local()
 
     def set_name(self, name):
         self.s.headers.update({'user-agent': VOCADB_USER_AGENT.format(bot_name=name)})
 
-    def base(self, api, params, process=True):
-        if process:
-            params.update(self.opts)
-        r = self.s.get(VOCADB_API_ENDPOINT + api, params=params)
+    @contextmanager
+    def priority(self, priority):
+        """Requests made by this thread inside the with block are rate limited with the given priority."""
+        previous = getattr(self._local, 'priority', Priority.normal)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def stats(self):
+        stats = {'requests': self.in_flight.calls, 'coalesced': self.in_flight.coalesced}
+        stats.update({'cache_' + name: value for name, value in self.cache.stats().items()})
+        if self.disk_cache:
+            stats.update({'disk_cache_' + name: value for name, value in self.disk_cache.stats().items()})
+        if self.shared_cache:
+            stats.update({'shared_cache_' + name: value for name, value in self.shared_cache.stats().items()})
+        stats.update({'entity_hits': self.entity_hits, 'entity_upgrades': self.entity_upgrades})
+        stats.update({'retries': self.retries, 'stale_served': self.stale, 'breaker_state': self.breaker.state,
+                      'breaker_opened': self.breaker.opened})
+        stats.update({'limiter_' + name: value for name, value in self.limiter.stats().items()})
+        return stats
+
+    def base(self, api, params, process=True, persist=False):
+        # Copy since the pagers keep reusing (and changing) their payload dicts
+        params = dict(params, **self.opts) if process else dict(params)
+        key = request_key(api, params)
+        data = self.cache.get(key)
+        if data is None and persist and self.disk_cache:
+            cached = self.disk_cache.get(key)
+            if cached:
+                data, ttl, size = cached
+                self.cache.set(key, data, ttl=ttl, size=size)
+        if data is None and self.shared_cache:
+            shared = self.shared_cache.get(key)
+            if shared:
+                data, expires, size = shared
+                self.cache.set(key, data, ttl=expires - time.time(), size=size)
+        if data is None:
+            try:
+                data = self.in_flight.do(key, lambda: self.fetch(api, params, key, persist))
+            except (requests.RequestException, VocaDBUnavailable) as e:
+                # Better old data than no data
+                data = self.cache.get(key, stale=True)
+                if data is None:
+                    raise
+                logger.warning('Serving stale response for %s: %s', key, e)
+                self.stale += 1
+        return data
+
+    def fetch(self, api, params, key, persist=False):
+        if not self.breaker.allow():
+            raise VocaDBUnavailable('Too many failed requests to VocaDB, not trying right now.')
+        success = False
+        try:
+            for attempt in range(VOCADB_RETRIES + 1):
+                self.limiter.acquire(getattr(self._local, 'priority', Priority.normal))
+                try:
+                    r = self.s.get(VOCADB_API_ENDPOINT + api, params=params,
+                                   timeout=by_endpoint(TIMEOUTS, api, TIMEOUT_DEFAULT))
+                    if r.status_code in RETRY_STATUSES:
+                        r.raise_for_status()
+                    break
+                except requests.RequestException as e:
+                    if attempt == VOCADB_RETRIES:
+                        raise
+                    logger.info('VocaDB request failed, retrying: %s', e)
+                    self.retries += 1
+                    time.sleep(backoff(attempt))
+            success = True
+        finally:
+            # Whatever went wrong has to be recorded, a half-open breaker waits for the trial's result
+            self.breaker.record(success)
         if not r.status_code == requests.codes.ok:
             logger.warning('Problem with HTTP request.')
             # If it's a 404, it's probably because user did something stupid, so we ignore it
             if not r.status_code == 404:
                 r.raise_for_status()
-        logger.debug(r.text)
-        try:
-            # Not using request json recoder since we want to strip stuff that telegram doesn't like
-            data = json.loads(escape_bad_html(r.text))
-        except ValueError as e:
-            logger.warning('Non-JSON returned from VocaDB API endpoint: %s', e)
-            return None
+        logger.debug('GET %s: %s (%d bytes)', r.url, r.status_code, len(r.content))
+        data = parse_response(r.content)
+        if data is not None and r.status_code == requests.codes.ok:
+            # The body length is a decent enough estimate of how much memory the parsed data takes up
+            ttl = cache_ttl(api, params)
+            self.cache.set(key, data, ttl=ttl, size=len(r.content))
+            if persist and self.disk_cache:
+                self.disk_cache.set(key, data, ttl)
+            if self.shared_cache:
+                self.shared_cache.set(key, (data, time.time() + ttl, len(r.content)), ttl=ttl)
         return data
 
-    def entries(self, query, lang, max_results=3, sort='Name'):
-        payload = {'query': query, 'lang': lang, 'fields': 'MainPicture, Names, PVs', 'sort': sort,
-                   'maxResults': max_results}
+    def search(self, api, payload, max_results):
+        """Pager for the search endpoints. Fetches a whole block of results at a time and serves pages from the last
+        fetched block, so only crossing a block edge costs a request."""
+        block_size = search_block_size(max_results)
+        state = {'block': None}
+
+        def load(wanted):
+            """Fetches the (start, count) block, if there is one. False if that didn't work."""
+            if wanted:
+                data = self.base(api, dict(payload, start=wanted[0], maxResults=wanted[1]))
+                if not data:
+                    return False
+                state['block'] = new_block(wanted[0], data)
+            return True
 
         def page(i):
-            payload.update({'start': (i - 1) * max_results})
-            data = self.base('entries', payload)
-            if data:
-                found = data['items']
-                return found, ((i - 1) * max_results, data['totalCount']), Context.search
-
-        return page
-
-    def songs(self, query, lang, max_results=3, sort='FavoritedTimes', artist_id='', originals_only=False):
-        payload = {'query': query, 'lang': lang, 'fields': 'MainPicture, Names, Artists', 'sort': sort,
-                   'maxResults': max_results, 'artistId': artist_id}
-
-        if originals_only:
-            payload.update({'songTypes': 'Original'})
+            offset = (i - 1) * max_results
+            if not load(page_block(state['block'], offset, block_size)):
+                return None
+            return block_page(state['block'], offset, max_results)
 
-        def page(i):
-            payload.update({'start': (i - 1) * max_results})
-            data = self.base('songs', payload)
-            if data:
-                found = data['items']
-                return found, ((i - 1) * max_results, data['totalCount']), Context.search
+        def items(offset, count):
+            """Like page, but for any number of results from any offset."""
+            if not load(items_block(state['block'], offset, count, block_size)):
+                return None
+            return block_page(state['block'], offset, count)
 
+        page.items = items
         return page
 
-    def artists(self, query, lang, max_results=3, sort='FollowerCount'):
-        payload = {'query': query, 'lang': lang, 'fields': 'MainPicture, Names', 'sort': sort,
-                   'maxResults': max_results}
+    def entries(self, query, lang, max_results=3, sort='Name'):
+        return self.search('entries', entries_payload(query, lang, sort), max_results)
 
-        def page(i):
-            payload.update({'start': (i - 1) * max_results})
-            data = self.base('artists', payload)
-            if data:
-                found = data['items']
-                return found, ((i - 1) * max_results, data['totalCount']), Context.search
+    def songs(self, query, lang, max_results=3, sort='FavoritedTimes', artist_id='', originals_only=False):
+        return self.search('songs', songs_payload(query, lang, sort, artist_id, originals_only), max_results)
 
-        return page
+    def artists(self, query, lang, max_results=3, sort='FollowerCount'):
+        return self.search('artists', artists_payload(query, lang, sort), max_results)
 
     def albums(self, query, lang, max_results=3, sort='NameThenReleaseDate', artist_id=''):
-        payload = {'query': query, 'lang': lang, 'fields': 'MainPicture, Names', 'sort': sort,
-                   'maxResults': max_results, 'artistId': artist_id}
+        return self.search('albums', albums_payload(query, lang, sort, artist_id), max_results)
+
+    def listing(self, fetch, shape):
+        """Pager for endpoints that return the whole list at once. It is fetched on the first page and only a compact
+        copy is kept around, all later pages are sliced from that."""
+        state = {'data': None}
 
         def page(i):
-            payload.update({'start': (i - 1) * max_results})
-            data = self.base('albums', payload)
-            if data:
-                found = data['items']
-                return found, ((i - 1) * max_results, data['totalCount']), Context.search
+            if state['data'] is None:
+                state['data'] = fetch()
+            return shape(state['data'], i)
 
         return page
 
     def albums_by_song(self, song_id, lang, max_results=3):
-        payload = {'fields': 'Albums', 'lang': lang}
-
-        def page(i):
-            offset = (i - 1) * max_results
-            data = self.base('songs/{}'.format(song_id), payload)
-            data = data['albums']
-            if data:
-                m = offset + max_results
-                if m > len(data):
-                    m = offset + ((len(data) - offset) % max_results)
-                d = data[offset:m]
-                return d, ((i - 1) * max_results, len(data)), Context.albums_by_song
+        return self.listing(lambda: compact((self.song(song_id, 'Albums', lang) or {}).get('albums')),
+                            lambda data, i: list_page(data, i, max_results, Context.albums_by_song))
+
+    def remember_fields(self, api, lang, fields, ttl=None):
+        known = self.entity_fields.get((api, lang))
+        if known is None or not fields < known:
+            self.entity_fields.set((api, lang), fields, ttl=ttl)
+
+    def entity(self, api, fields, lang):
+        """Fetches an entity, answering from any cached response of it that has at least the wanted fields.
+        If some are missing we fetch the union of the two instead, so the next request can be answered by that."""
+        fields = split_fields(fields)
+        known = self.entity_fields.get((api, lang))
+        if known is not None:
+            if fields <= known:
+                self.entity_hits += 1
             else:
-                return [], (0, 0), Context.albums_by_song
-
-        return page
+                self.entity_upgrades += 1
+            fields = fields | known
+        data = self.base(api, {'fields': ', '.join(sorted(fields)), 'lang': lang}, persist=True)
+        if data is not None:
+            self.remember_fields(api, lang, fields)
+        return data
 
     def song(self, song_id, fields, lang):
-        payload = {'fields': fields, 'lang': lang}
-        data = self.base('songs/{}'.format(song_id), payload)
-        return data
+        return self.entity('songs/{}'.format(song_id), fields, lang)
 
     def artist(self, artist_id, fields, lang):
-        payload = {'fields': fields, 'lang': lang}
-        data = self.base('artists/{}'.format(artist_id), payload)
-        return data
+        return self.entity('artists/{}'.format(artist_id), fields, lang)
 
-    def album(self, artist_id, fields, lang):
-        payload = {'fields': fields, 'lang': lang}
-        data = self.base('albums/{}'.format(artist_id), payload)
-        return data
+    def album(self, album_id, fields, lang):
+        return self.entity('albums/{}'.format(album_id), fields, lang)
 
     def song_by_pv(self, service, pv_id, fields, lang):
-        payload = {'pvService': service, 'pvId': pv_id, 'fields': fields, 'lang': lang}
-        data = self.base('songs/byPv', payload, process=False)
+        data = self.base('songs/byPv', pv_payload(service, pv_id, fields, lang), process=False, persist=True)
         return data
 
     def derived(self, song_id, lang, max_results=3):
-        payload = {'fields': 'MainPicture', 'lang': lang}
-
-        def page(i):
-            offset = (i - 1) * max_results
-            data = self.base('songs/{}/derived'.format(song_id), payload)
-            if data:
-                m = offset + max_results
-                if m > len(data):
-                    m = offset + ((len(data) - offset) % max_results)
-                d = data[offset:m]
-                return d, ((i - 1) * max_results, len(data)), Context.derived
-            else:
-                return [], (0, 0), Context.derived
-
-        return page
+        payload = song_list_payload(lang)
+        return self.listing(lambda: compact(self.base('songs/{}/derived'.format(song_id), payload)),
+                            lambda data, i: list_page(data, i, max_results, Context.derived))
 
     # Hardcoded to 3 entries... because...
     def related(self, song_id, lang):
-        payload = {'fields': 'MainPicture', 'lang': lang}
+        payload = song_list_payload(lang)
 
-        def page(i):
+        def fetch():
             data = self.base('songs/{}/related'.format(song_id), payload)
             if data:
-                r = []
-                smallest = 100
-                for match_type in ['artistMatches', 'likeMatches', 'tagMatches']:
-                    if not data[match_type]:
-                        break
-                    r.append(data[match_type][i - 1])
-                    smallest = len(data[match_type]) if len(data[match_type]) < smallest else smallest
-                else:
-                    return r, ((i - 1) * 3, smallest * 3), Context.related
-            return [], (0, 0), Context.related
+                return {match_type: compact(data[match_type]) for match_type in RELATED_MATCH_TYPES}
 
-        return page
+        return self.listing(fetch, related_page)
 
     def top_rated_songs(self, lang, max_results=3, hours=48):
-        # Get max 10 pages
-        payload = {'durationHours': hours, 'languagePreference': lang, 'fields': 'MainPicture, Names, Artists',
-                   'maxResults': 10 * max_results, 'filterBy': 'PublishDate'}
-
-        def page(i):
-            offset = (i - 1) * max_results
-            data = self.base('songs/top-rated', payload)
-            if data:
-                m = offset + max_results
-                if m > len(data):
-                    m = offset + ((len(data) - offset) % max_results)
-                d = data[offset:m]
-                return d, ((i - 1) * max_results, len(data)), Context.search
-            else:
-                return [], (0, 0), Context.search
-
-        return page
+        payload = top_rated_payload(lang, max_results, hours)
+        return self.listing(lambda: compact(self.base('songs/top-rated', payload)),
+                            lambda data, i: list_page(data, i, max_results, Context.search))
 
     def resources(self, culture_code, set_names=None):
         payload = {'setNames': set_names}
-        data = self.base('resources/{}'.format(culture_code), payload, process=False)
+        data = self.base('resources/{}'.format(culture_code), payload, process=False, persist=True)
         return data
 
+    def type_names(self, culture_code, refresh=False):
+        """Lookup tables for translated song, artist and album types in the given language."""
+        names = self._resources.get(culture_code)
+        if names is None or refresh:
+            data = self.resources(culture_code, list(RESOURCE_SETS.values()))
+            if data is None:
+                return names or {}
+            names = self._resources[culture_code] = {kind: data.get(set_name) or {}
+                                                     for kind, set_name in RESOURCE_SETS.items()}
+        return names
+
     def trans(self, s, song=False, artist=False, album=False):
-        if _.code not in self._resources:
-            self._resources[_.code] = self.resources(_.code, ['songTypeNames', 'artistTypeNames', 'discTypeNames'])
-        try:
-            if song:
-                return self._resources[_.code]['songTypeNames'][s]
-            if artist:
-                return self._resources[_.code]['artistTypeNames'][s]
-            if album:
-                return self._resources[_.code]['albumTypeNames'][s]
-        except KeyError:
-            return s
+        kind = 'song' if song else 'artist' if artist else 'album' if album else None
+        return self.type_names(_.code).get(kind, {}).get(s, s)
+
+
+class AsyncVocaDB(object):
+    """asyncio version of VocaDB. Every request shares one pooled keep-alive aiohttp session, and the pagers return
+    coroutine functions instead of plain ones.
+
+    Requests go straight to VocaDB: none of the caching, request coalescing, retries, circuit breaker or rate limiting
+    VocaDB.base does is done here."""
+
+    def __init__(self, max_connections=100, keepalive_timeout=30):
+        self.headers = {'Accept': 'application/json', 'User-Agent': VOCADB_USER_AGENT}
+        self.opts = {'nameMatchMode': 'Auto', 'getTotalCount': 'true'}
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    def set_name(self, name):
+        self.headers.update({'User-Agent': VOCADB_USER_AGENT.format(bot_name=name)})
+        if self._session is not None:
+            self._session.headers.update({'User-Agent': self.headers['User-Agent']})
+
+    @property
+    def session(self):
+        # Has to be created lazily since aiohttp wants a running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def base(self, api, params, process=True):
+        params = dict(params, **self.opts) if process else dict(params)
+        connect, read = by_endpoint(TIMEOUTS, api, TIMEOUT_DEFAULT)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        async with self.session.get(VOCADB_API_ENDPOINT + api, params=query_params(params), timeout=timeout) as r:
+            if not r.status == requests.codes.ok:
+                logger.warning('Problem with HTTP request.')
+                # If it's a 404, it's probably because user did something stupid, so we ignore it
+                if not r.status == 404:
+                    r.raise_for_status()
+            body = await r.read()
+        logger.debug('GET %s: %s (%d bytes)', r.url, r.status, len(body))
+        return parse_response(body)
+
+    def search(self, api, payload, max_results):
+        block_size = search_block_size(max_results)
+        state = {'block': None}
+
+        async def load(wanted):
+            if wanted:
+                data = await self.base(api, dict(payload, start=wanted[0], maxResults=wanted[1]))
+                if not data:
+                    return False
+                state['block'] = new_block(wanted[0], data)
+            return True
+
+        async def page(i):
+            offset = (i - 1) * max_results
+            if not await load(page_block(state['block'], offset, block_size)):
+                return None
+            return block_page(state['block'], offset, max_results)
+
+        async def items(offset, count):
+            """Like page, but for any number of results from any offset."""
+            if not await load(items_block(state['block'], offset, count, block_size)):
+                return None
+            return block_page(state['block'], offset, count)
+
+        page.items = items
+        return page
+
+    def entries(self, query, lang, max_results=3, sort='Name'):
+        return self.search('entries', entries_payload(query, lang, sort), max_results)
+
+    def songs(self, query, lang, max_results=3, sort='FavoritedTimes', artist_id='', originals_only=False):
+        return self.search('songs', songs_payload(query, lang, sort, artist_id, originals_only), max_results)
+
+    def artists(self, query, lang, max_results=3, sort='FollowerCount'):
+        return self.search('artists', artists_payload(query, lang, sort), max_results)
+
+    def albums(self, query, lang, max_results=3, sort='NameThenReleaseDate', artist_id=''):
+        return self.search('albums', albums_payload(query, lang, sort, artist_id), max_results)
+
+    def albums_by_song(self, song_id, lang, max_results=3):
+        async def page(i):
+            data = await self.song(song_id, 'Albums', lang)
+            return list_page((data or {}).get('albums'), i, max_results, Context.albums_by_song)
+
+        return page
+
+    async def song(self, song_id, fields, lang):
+        return await self.base('songs/{}'.format(song_id), {'fields': fields, 'lang': lang})
+
+    async def artist(self, artist_id, fields, lang):
+        return await self.base('artists/{}'.format(artist_id), {'fields': fields, 'lang': lang})
+
+    async def album(self, album_id, fields, lang):
+        return await self.base('albums/{}'.format(album_id), {'fields': fields, 'lang': lang})
+
+    async def song_by_pv(self, service, pv_id, fields, lang):
+        return await self.base('songs/byPv', pv_payload(service, pv_id, fields, lang), process=False)
+
+    def derived(self, song_id, lang, max_results=3):
+        async def page(i):
+            data = await self.base('songs/{}/derived'.format(song_id), song_list_payload(lang))
+            return list_page(data, i, max_results, Context.derived)
+
+        return page
+
+    def related(self, song_id, lang):
+        async def page(i):
+            data = await self.base('songs/{}/related'.format(song_id), song_list_payload(lang))
+            return related_page(data, i)
+
+        return page
+
+    def top_rated_songs(self, lang, max_results=3, hours=48):
+        payload = top_rated_payload(lang, max_results, hours)
+
+        async def page(i):
+            data = await self.base('songs/top-rated', payload)
+            return list_page(data, i, max_results, Context.search)
+
+        return page
+
+    async def resources(self, culture_code, set_names=None):
+        return await self.base('resources/{}'.format(culture_code), {'setNames': set_names}, process=False)
+
+
+def prioritized(priority):
+    """Decorator making all VocaDB requests done by a handler use the given priority."""
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with voca_db.priority(priority):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 voca_db = VocaDB()
@@ -0,0 +1,31 @@
+import logging
+
+from constants import Priority, WARMUP_HOT_LISTS
+from settings import INTERFACE_LANGUAGES, VOCADB_LANGUAGES
+from vocadb import voca_db
+
+logger = logging.getLogger(__name__)
+
+
+def hot_lists(lang):
+    return [voca_db.songs('', lang), voca_db.songs('', lang, sort='AdditionDate'), voca_db.top_rated_songs(lang)]
+
+
+# noinspection PyUnusedLocal
+def warmup(bot=None, job=None):
+    """Loads the type translations for every interface language and, if enabled, the first page of /top, /new and
+    /trending in every VocaDB language. Can be used directly or as a job callback."""
+    with voca_db.priority(Priority.background):
+        for code in INTERFACE_LANGUAGES:
+            try:
+                voca_db.type_names(code, refresh=True)
+            except Exception as e:
+                logger.warning('Could not load translations for %s: %s', code, e)
+
+        if WARMUP_HOT_LISTS:
+            for lang in VOCADB_LANGUAGES:
+                for page in hot_lists(lang):
+                    try:
+                        page(1)
+                    except Exception as e:
+                        logger.warning('Could not prefetch list in %s: %s', lang, e)